@@ -27,6 +27,7 @@ export enum CFDraw_Toast_Words {
   "submit-task-success-message" = "submit-task-success-message",
   "submit-task-error-message" = "submit-task-error-message",
   "submit-task-interrupted-message" = "submit-task-interrupted-message",
+  "submit-task-rejected-message" = "submit-task-rejected-message",
   "submit-task-finished-message" = "submit-task-finished-message",
   "enter-brush-mode-message" = "enter-brush-mode-message",
   "exit-brush-mode-message" = "exit-brush-mode-message",
@@ -62,6 +63,7 @@ export const toastLangRecords: Record<Lang, Record<CFDraw_Toast_Words, string>>
     [CFDraw_Toast_Words["submit-task-success-message"]]: "任务提交成功",
     [CFDraw_Toast_Words["submit-task-error-message"]]: "执行任务时出了些问题",
     [CFDraw_Toast_Words["submit-task-interrupted-message"]]: "任务执行被中断",
+    [CFDraw_Toast_Words["submit-task-rejected-message"]]: "服务器繁忙，请稍后再试",
     [CFDraw_Toast_Words["submit-task-finished-message"]]: "任务已执行完成",
     [CFDraw_Toast_Words["enter-brush-mode-message"]]: "已进入涂鸦模式",
     [CFDraw_Toast_Words["exit-brush-mode-message"]]: "已退出涂鸦模式",
@@ -99,6 +101,7 @@ export const toastLangRecords: Record<Lang, Record<CFDraw_Toast_Words, string>>
     [CFDraw_Toast_Words["submit-task-success-message"]]: "Task submitted successfully!",
     [CFDraw_Toast_Words["submit-task-error-message"]]: "Something is wrong when executing the task",
     [CFDraw_Toast_Words["submit-task-interrupted-message"]]: "Task submission is interrupted",
+    [CFDraw_Toast_Words["submit-task-rejected-message"]]: "Server is busy, please try again later",
     [CFDraw_Toast_Words["submit-task-finished-message"]]: "Task has been executed successfully",
     [CFDraw_Toast_Words["enter-brush-mode-message"]]: "Entered sketch mode",
     [CFDraw_Toast_Words["exit-brush-mode-message"]]: "Exited sketch mode",
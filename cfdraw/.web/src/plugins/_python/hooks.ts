@@ -23,7 +23,12 @@ import { IMetaInjections, getMetaInjection } from "@/stores/meta";
 import { setPluginMessage, usePluginIds, usePluginNeedRender } from "@/stores/pluginsInfo";
 import { useSocketPython } from "@/hooks/usePython";
 import { checkHasConstraint } from "../utils/renderFilters";
-import { cleanupException, cleanupFinished, cleanupInterrupted } from "../utils/cleanup";
+import {
+  cleanupException,
+  cleanupFinished,
+  cleanupInterrupted,
+  cleanupRejected,
+} from "../utils/cleanup";
 import { socketFinishedEvent } from "./PluginWithSubmit";
 
 export function useDefinitionsRequestDataFn(definitions: IDefinitions): () => Dictionary<any> {
@@ -120,6 +125,10 @@ export function useOnMessage({
           cleanupInterrupted({ id, message });
           break;
         }
+        case "rejected": {
+          cleanupRejected({ id, message });
+          break;
+        }
       }
       return {};
     },
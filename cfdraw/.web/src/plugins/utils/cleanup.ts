@@ -60,3 +60,10 @@ export function cleanupInterrupted({ id, message: { hash, message } }: ICleanupI
   });
   cleanup(id, hash);
 }
+
+export function cleanupRejected({ id, message: { hash, message } }: ICleanupInterrupted): void {
+  toastWord("warning", CFDraw_Toast_Words["submit-task-rejected-message"], {
+    appendix: ` - ${message}`,
+  });
+  cleanup(id, hash);
+}
@@ -97,6 +97,19 @@ export interface IPythonSocketRequest {
   nodeDataList: INodeData[];
   extraData: Dictionary<any>;
   isInternal?: boolean;
+  deadline?: number; // unix timestamp (seconds), pending requests will be dropped after it
+}
+// send this to cancel a pending / running task, an `interrupted` message will be returned
+export interface IPythonSocketCancelRequest {
+  type: "cancel";
+  hash: string;
+  userId: string;
+}
+// send this to re-attach to a task after reconnecting, only works when `durable_queue` is enabled
+export interface IPythonSocketAttachRequest {
+  type: "attach";
+  hash: string;
+  userId: string;
 }
 export type IPythonOnSocketMessage<R> = (data: IPythonSocketMessage<R>) => Promise<
   | {
@@ -125,17 +138,28 @@ export interface IPythonSocketCallbacks<R> extends IPythonCallbacks, IPythonSock
   onSocketError?: (err: any) => void;
 }
 
-export type PythonSocketStatus = "pending" | "working" | "finished" | "exception" | "interrupted";
+export type PythonSocketStatus =
+  | "pending"
+  | "working"
+  | "finished"
+  | "exception"
+  | "interrupted"
+  | "rejected";
 interface IPythonSocketIntermediate {
   imageList?: string[]; // intermediate images, if any
   textList?: string[]; // intermediate texts, if any
 }
+export interface IPythonEstimatedTimes {
+  startTime?: number;
+  finishTime?: number;
+}
 export interface IPythonSocketResponse<R> {
   progress?: number; // progress of current task, should be within [0, 1]
   intermediate?: IPythonSocketIntermediate;
   final?: R;
   injections?: IMetaInjections;
   elapsedTimes?: IElapsedTimes;
+  estimatedTimes?: IPythonEstimatedTimes; // only available in `pending` messages
 }
 export interface IPythonSocketMessage<R> {
   hash: string;
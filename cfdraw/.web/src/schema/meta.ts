@@ -8,7 +8,9 @@ export interface IElapsedTimes {
   endTime?: number;
   pending?: number;
   executing?: number;
+  process?: number;
   upload?: number;
+  uploads?: number[];
   total?: number;
 }
 
@@ -8,8 +8,10 @@ import type {
   IPythonSocketRequest,
   IPythonSocketMessage,
   IPythonOnSocketMessage,
+  IPythonSocketAttachRequest,
 } from "@/schema/_python";
 import { getBaseURL } from "@/utils/misc";
+import { userStore } from "@/stores/user";
 import { settingsStore } from "@/stores/settings";
 
 const DEBUG = false;
@@ -23,6 +25,10 @@ interface SocketHook<R> {
   timer?: any;
   shouldTerminate?: boolean;
   isInternal?: boolean;
+  // whether the request is sent, and whether it should be re-attached (instead of
+  // being sent again) after reconnecting
+  sent?: boolean;
+  attach?: boolean;
 }
 
 export interface ISocketStore {
@@ -56,6 +62,13 @@ class SocketStore extends ABCStore<ISocketStore> implements ISocketStore {
         return;
       }
       const hash = hook.key;
+      if (hook.attach) {
+        hook.attach = false;
+        socketLog(`>> attach (${hash})`);
+        const data: IPythonSocketAttachRequest = { type: "attach", hash, userId: userStore.userId };
+        socketStore.socket!.send(JSON.stringify(data));
+        return;
+      }
       socketLog(`>> send message (${hash})`);
 
       const send = () => {
@@ -71,6 +84,7 @@ class SocketStore extends ABCStore<ISocketStore> implements ISocketStore {
               return;
             }
             socketStore.socket!.send(JSON.stringify(data));
+            hook.sent = true;
             socketLog(`>>> message sent (${hash})`);
             if (hook.updateInterval && !hook.shouldTerminate) {
               hook.timer = setTimeout(send, hook.updateInterval);
@@ -170,7 +184,7 @@ export const runOneTimeSocketHook = async <R>({
         keyCaches.results[hookKey] = final;
         clear(key, hookKey, timeout);
         resolve(final);
-      } else if (status === "exception") {
+      } else if (status === "exception" || status === "rejected") {
         Logger.warn(`runOneTimeSocketHook (${key}) failed: ${message}`);
         resolve(undefined);
       }
@@ -253,8 +267,12 @@ export function useWebSocket(opt?: IUseWebSocket) {
           `Socket connection closed (reason: ${e.reason}), ` +
             "cleaning up external hooks and retrying...",
         );
+        // sent requests will be re-attached after reconnecting, so their results will
+        // still be received (if `durable_queue` is enabled at the backend, otherwise an
+        // `interrupted` message will be received)
         const externalHooks = socketStore.hooks.filter((h) => !h.isInternal);
-        removeSocketHooks(...externalHooks.map((h) => h.key));
+        externalHooks.forEach((h) => (h.attach = !!h.sent && !h.updateInterval));
+        removeSocketHooks(...externalHooks.filter((h) => !h.attach).map((h) => h.key));
         timer = setTimeout(_connect, interval);
       };
       socket.onerror = (err) => {
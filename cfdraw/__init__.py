@@ -7,6 +7,9 @@ from cfdraw.config import Config
 from cfdraw.utils.misc import offload
 from cfdraw.utils.misc import offload_run
 from cfdraw.utils.cache import cache_resource
+from cfdraw.utils.storage import IBlobStorage
+from cfdraw.utils.storage import register_storage_backend
+from cfdraw.app.endpoints.scheduler import register_scheduler
 
 register_plugin = PluginFactory.register
 
@@ -1,7 +1,11 @@
+import asyncio
+
 from typing import List
 from typing import Type
 from typing import Optional
 from typing import AsyncGenerator
+from aiohttp import ClientTimeout
+from aiohttp import TCPConnector
 from aiohttp import ClientSession
 from fastapi import FastAPI
 from contextlib import asynccontextmanager
@@ -12,6 +16,10 @@ from fastapi.middleware import cors
 from cfdraw import constants
 from cfdraw.utils import console
 from cfdraw.config import get_config
+from cfdraw.utils.misc import get_offload_pool
+from cfdraw.utils.server import get_hot_images
+from cfdraw.utils.remote import get_remote_fetcher
+from cfdraw.utils.storage import get_image_storage
 from cfdraw.app.schema import IApp
 from cfdraw.app.endpoints import *
 from cfdraw.schema.plugins import IPlugin
@@ -35,6 +43,19 @@ class App(IApp):
                 print_info(msg)
 
             info(f"🚀 Starting Backend Server at {self.config.api_url} ...")
+            # sessions should be created inside the running loop
+            self.http_session = ClientSession(
+                connector=TCPConnector(
+                    limit=self.config.http_max_connections,
+                    limit_per_host=self.config.http_max_connections_per_host,
+                ),
+                timeout=ClientTimeout(
+                    total=self.config.http_timeout,
+                    sock_connect=self.config.http_connect_timeout,
+                ),
+            )
+            loop = asyncio.get_running_loop()
+            get_remote_fetcher().bind(loop)
             info("🔨 Compiling Plugins & Endpoints...")
             tplugin_with_notification: List[Type[IPlugin]] = []
             for tplugin in self.plugins.values():
@@ -55,6 +76,11 @@ class App(IApp):
                 console.rule("")
             for endpoint in self.endpoints:
                 await endpoint.on_startup()
+            if self.config.defer_image_persistence:
+                get_hot_images().bind(loop)
+            num_restored = await self.request_queue.restore(self.plugins)
+            if num_restored > 0:
+                info(f"♻️  {num_restored} unfinished tasks are restored")
             upload_root_path = self.config.upload_root_path
             info(f"🔔 Your files will be saved to '{upload_root_path}'")
             info("🎉 Backend Server is Ready!")
@@ -63,19 +89,33 @@ class App(IApp):
 
             # shutdown
 
+            deadline = loop.time() + self.config.shutdown_timeout
+            # running tasks are drained first (including their responding stages, which
+            # need the pools, the sessions & the storage), so their results are kept
+            await self.request_queue.shutdown(self.config.shutdown_timeout)
+            # shutting down the pools blocks, and the running plugins may need the loop
+            timeout = max(0.0, deadline - loop.time())
+            await asyncio.gather(
+                loop.run_in_executor(None, get_offload_pool().shutdown, timeout),
+                loop.run_in_executor(None, self.fast_lane.shutdown, timeout),
+            )
+            # images produced by the drained tasks should be persisted as well
+            await get_hot_images().flush()
+            await get_remote_fetcher().unbind()
             await self.http_session.close()
             for tplugin in self.plugins.values():
                 tplugin.http_session = None
+            self.http_session = None
             for endpoint in self.endpoints:
                 await endpoint.on_shutdown()
-            self.http_session = None
+            # the workers have closed their own storage sessions when they stopped
+            await get_image_storage().close()
 
         # config
         self.config = get_config()
-        # clients
-        self.http_session = ClientSession()
-        # queue
-        self.request_queue = RequestQueue()
+        # queue & lanes
+        self.request_queue = RequestQueue(self.config)
+        self.fast_lane = FastLane(self.config)
         # fastapi
         self.api = FastAPI(lifespan=lifespan)
         self.add_cors()
@@ -84,6 +124,7 @@ class App(IApp):
             UploadEndpoint(self),
             ProjectEndpoint(self),
             WebsocketEndpoint(self),
+            StatsEndpoint(self),
         ]
         if self.config.use_unified:
             self.endpoints.append(AssetsEndpoint(self))
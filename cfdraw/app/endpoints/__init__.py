@@ -4,3 +4,5 @@ from .upload import *
 from .project import *
 from .websocket import *
 from .queue import *
+from .lane import *
+from .stats import *
@@ -0,0 +1,140 @@
+# A simple sqlite based write-ahead journal of the `RequestQueue`
+# Should be easy to replace with a more 'formal' database based one
+
+import time
+import asyncio
+import logging
+import sqlite3
+import threading
+
+from typing import Any
+from typing import List
+from typing import Tuple
+from typing import Optional
+from pathlib import Path
+from cftool.misc import print_warning
+from concurrent.futures import ThreadPoolExecutor
+
+from cfdraw.schema.plugins import ISocketRequest
+from cfdraw.schema.plugins import ISocketMessage
+
+
+class QueueJournal:
+    """
+    Records the lifecycle (pending -> running -> finished) of the tasks, so unfinished
+    tasks can be restored after the backend restarts.
+    > The final messages of the tasks are also recorded, so reconnecting clients can
+    still fetch the results.
+    > Writes are executed in a dedicated thread, so they will not block the event
+    loop. Reads are executed there as well, so they will see the previous writes.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self._lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix="cfdraw-journal")
+        # messages may be recorded in the offloaded threads
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "create table if not exists tasks ("
+            "uid text PRIMARY KEY, hash text, user_id text, request text, "
+            "status text, create_time real, update_time real, result text)"
+        )
+        self._conn.execute("create index if not exists tasks_hash on tasks (hash)")
+        self._conn.commit()
+
+    def push(self, uid: str, request: ISocketRequest) -> None:
+        now = time.time()
+        self._execute(
+            "INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?, ?, ?, NULL)",
+            [uid, request.hash, request.userId, request.json(), "pending", now, now],
+        )
+
+    def start(self, uid: str) -> None:
+        self._set_status(uid, "running")
+
+    def finish(self, uid: str) -> None:
+        self._set_status(uid, "finished")
+
+    def record(self, uid: str, message: ISocketMessage) -> None:
+        self._execute(
+            "UPDATE tasks SET result=?, update_time=? WHERE uid=?",
+            [message.json(), time.time(), uid],
+        )
+
+    async def unfinished(self) -> List[Tuple[str, ISocketRequest]]:
+        """return the unfinished tasks, in the order they were pushed"""
+
+        rows = await self._fetch(
+            "SELECT uid, request FROM tasks WHERE status!='finished' "
+            "ORDER BY create_time",
+            [],
+        )
+        return [(uid, ISocketRequest.parse_raw(request)) for uid, request in rows]
+
+    async def get_result(self, user_id: str, hash: str) -> Optional[ISocketMessage]:
+        rows = await self._fetch(
+            "SELECT result FROM tasks WHERE hash=? AND user_id=? "
+            "AND result IS NOT NULL ORDER BY update_time DESC LIMIT 1",
+            [hash, user_id],
+        )
+        if not rows:
+            return None
+        return ISocketMessage.parse_raw(rows[0][0])
+
+    def prune(self, retention: float) -> None:
+        """remove the finished tasks which are older than `retention` seconds"""
+
+        self._execute(
+            "DELETE FROM tasks WHERE status='finished' AND update_time<?",
+            [time.time() - retention],
+        )
+
+    def close(self) -> None:
+        """
+        Wait for the pending writes and close the journal, later writes are ignored.
+        > This method blocks, so it should not be called in the event loop.
+        """
+
+        self._writer.shutdown()
+        with self._lock:
+            self._conn.close()
+
+    def _set_status(self, uid: str, status: str) -> None:
+        self._execute(
+            "UPDATE tasks SET status=?, update_time=? WHERE uid=?",
+            [status, time.time(), uid],
+        )
+
+    def _execute(self, sql: str, params: List[Any]) -> None:
+        try:
+            self._writer.submit(self._write, sql, params)
+        except RuntimeError:
+            print_warning(f"journal is closed, '{sql}' is ignored")
+
+    def _write(self, sql: str, params: List[Any]) -> None:
+        # journaling is best-effort, it should never break the queue
+        try:
+            with self._lock:
+                self._conn.execute(sql, params)
+                self._conn.commit()
+        except Exception:
+            logging.exception(f"failed to execute '{sql}'")
+
+    async def _fetch(self, sql: str, params: List[Any]) -> List[Any]:
+        # reads are queued behind the pending writes, so they are awaited off the loop
+        future = self._writer.submit(self._read, sql, params)
+        return await asyncio.wrap_future(future)
+
+    def _read(self, sql: str, params: List[Any]) -> List[Any]:
+        try:
+            with self._lock:
+                return self._conn.execute(sql, params).fetchall()
+        except Exception:
+            logging.exception(f"failed to execute '{sql}'")
+            return []
+
+
+__all__ = [
+    "QueueJournal",
+]
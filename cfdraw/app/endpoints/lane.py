@@ -0,0 +1,72 @@
+import asyncio
+import logging
+
+from typing import Any
+from typing import Set
+from typing import Dict
+from typing import Optional
+from cftool.misc import get_err_msg
+from cftool.misc import print_error
+
+from cfdraw.config import Config
+from cfdraw.config import get_config
+from cfdraw.app.schema import IFastLane
+from cfdraw.utils.misc import OffloadPool
+from cfdraw.schema.plugins import IPlugin
+from cfdraw.schema.plugins import ISocketRequest
+from cfdraw.schema.plugins import ISocketMessage
+
+
+class FastLane(IFastLane):
+    """
+    Execute requests directly in a dedicated `OffloadPool`, so they will neither
+    wait behind the heavy tasks in the `RequestQueue`, nor affect their positions.
+    """
+
+    def __init__(self, config: Optional[Config] = None) -> None:
+        if config is None:
+            config = get_config()
+        self._pool = OffloadPool(config.fast_lane_workers)
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return dict(num_running=len(self._tasks), **self._pool.stats)
+
+    def submit(self, plugin: IPlugin, request: ISocketRequest) -> None:
+        task = asyncio.create_task(self._run(plugin, request))
+        # keep a reference so the task will not be garbage collected halfway
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, plugin: IPlugin, request: ISocketRequest) -> None:
+        prefix = f"[fast_lane] [{request.hash}]"
+        timeout = plugin.settings.timeout
+        try:
+            plugin.elapsed_times.start()
+            future = plugin(request)
+            if not plugin.settings.no_offload:
+                future = self._pool.run(future)
+            await asyncio.wait_for(future, timeout)
+        except Exception as err:
+            if isinstance(err, asyncio.TimeoutError):
+                plugin.cancel()
+                reason = f"task is abandoned since it exceeds the timeout ({timeout}s)"
+            else:
+                logging.exception(f"failed to execute plugin '{plugin}'")
+                reason = get_err_msg(err)
+            message = f"{prefix} {reason}"
+            try:
+                exception = ISocketMessage.make_exception(request.hash, message)
+                if not await plugin.send_message(exception):
+                    print_error(f"Failed to send following message: {message}")
+            except Exception:
+                logging.exception(f"{prefix} failed to send message '{message}'")
+
+    def shutdown(self, timeout: Optional[float] = None) -> None:
+        self._pool.shutdown(timeout)
+
+
+__all__ = [
+    "FastLane",
+]
@@ -1,9 +1,19 @@
+import time
+import heapq
 import asyncio
 import logging
 
+from typing import Any
+from typing import Set
 from typing import Dict
+from typing import List
 from typing import Tuple
 from typing import Optional
+from typing import Iterator
+from typing import Coroutine
+from typing import NamedTuple
+from collections import deque
+from collections import defaultdict
 from cftool.misc import get_err_msg
 from cftool.misc import print_error
 from cftool.misc import random_hash
@@ -11,27 +21,195 @@ from cftool.misc import print_warning
 from cftool.data_structures import Item
 from cftool.data_structures import QueuesInQueue
 
+from cfdraw.config import Config
+from cfdraw.config import get_config
 from cfdraw.app.schema import IRequestQueue
 from cfdraw.app.schema import IRequestQueueData
 from cfdraw.utils.misc import offload
+from cfdraw.utils.stats import get_elapsed_stats
+from cfdraw.utils.server import get_request_fingerprint
 from cfdraw.schema.plugins import ISend
+from cfdraw.schema.plugins import Responder
 from cfdraw.schema.plugins import SocketStatus
+from cfdraw.schema.plugins import ElapsedTimes
+from cfdraw.schema.plugins import EstimatedTimes
 from cfdraw.schema.plugins import ISocketMessage
+from cfdraw.schema.plugins import ISocketResponse
+from cfdraw.plugins.factory import Plugins
+from cfdraw.app.endpoints.journal import QueueJournal
+from cfdraw.app.endpoints.scheduler import make_scheduler
 
 
 DEBUG = False
+FINAL_STATUSES = {
+    SocketStatus.FINISHED,
+    SocketStatus.EXCEPTION,
+    SocketStatus.INTERRUPTED,
+}
+
+
+class Subscriber(NamedTuple):
+    """A client which is waiting for the results of the (leader) task `leader`."""
+
+    uid: str
+    leader: str
+    hash: str
+    user_id: str
+    session_id: Optional[str]
+    send: ISend
+    event: asyncio.Event
 
 
 class RequestQueue(IRequestQueue):
-    def __init__(self) -> None:
+    def __init__(self, config: Optional[Config] = None) -> None:
+        if config is None:
+            config = get_config()
+        self.num_workers = max(1, config.num_workers)
+        self.broadcast_interval = config.pending_broadcast_interval / 1000
+        self.cancel_on_disconnect = config.cancel_on_disconnect
+        self.max_queue_size = config.max_queue_size
+        self.max_pending_per_user = config.max_pending_per_user
+        self.max_wait_time = config.max_wait_time
+        self.journal_retention = config.durable_queue_retention
+        self._journal: Optional[QueueJournal] = None
+        # uids of the tasks whose final messages are recorded in the journal
+        self._recorded: Set[str] = set()
+        # when the app is shutting down, no more tasks will be scheduled
+        self._closing = False
+        if config.durable_queue:
+            path = config.upload_project_folder / "queue.sqlite"
+            self._journal = QueueJournal(path)
         self._queues = QueuesInQueue[IRequestQueueData]()
+        self._scheduler = make_scheduler(config)
+        self._items: Dict[str, Item[IRequestQueueData]] = {}
+        self._sessions: Dict[str, Set[str]] = defaultdict(set)
+        self._hashes: Dict[str, Set[str]] = defaultdict(set)
         self._senders: Dict[str, Tuple[str, ISend]] = {}
-        self._busy_uid: Optional[str] = None
+        self._running: Dict[str, IRequestQueueData] = {}
+        self._num_busy = 0
+        # pipelining, tasks which are responding do not occupy the workers
+        self._responding: Set[str] = set()
+        self.pipeline_buffer = config.pipeline_buffer
+        # created lazily, because the queue is created (in `App`) outside the loop
+        self._pipeline: Optional[asyncio.Semaphore] = None
+        self._concurrencies: Dict[str, int] = defaultdict(int)
+        # uid -> last broadcasted number of pending tasks ahead of it
+        self._positions: Dict[str, int] = {}
+        self._broadcast_handle: Optional[asyncio.TimerHandle] = None
+        # single-flight of `deterministic` tasks
+        ## fingerprint -> uid of the in-flight (leader) task
+        self._flights: Dict[str, str] = {}
+        ## leader uid -> subscribers (including the leader itself)
+        self._audiences: Dict[str, List[Subscriber]] = {}
+        ## subscriber uid -> subscriber
+        self._subscribers: Dict[str, Subscriber] = {}
+        # durable queue, uid -> sender of the currently attached client, if any
+        self._attached: Dict[str, Optional[ISend]] = {}
+        # uid -> handle which drops the task when its deadline passes
+        self._deadlines: Dict[str, asyncio.TimerHandle] = {}
+        # tasks created by the queue itself
+        self._background: Set[asyncio.Task] = set()
+        # the running `_execute`s, which are waited for when shutting down
+        self._executing: Set[asyncio.Task] = set()
+        # instrumentations
+        self._num_purged = 0
+        self._num_cancelled = 0
+        self._num_discarded = 0
+        self._num_coalesced = 0
+        self._num_rejected = 0
+        self._num_expired = 0
+        self._num_timeout = 0
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """
+        * num_purged: number of pending tasks removed because of cancellations or
+        disconnections, they never ran.
+        * num_cancelled: number of running tasks that were asked to cancel.
+        * num_discarded: number of finished tasks whose results were not responded
+        (and uploaded) because they were cancelled.
+        * num_coalesced: number of tasks attached to an identical in-flight task
+        instead of being executed.
+        * num_rejected: number of requests rejected by the admission control.
+        * num_expired: number of pending tasks dropped because of their deadlines.
+        * num_timeout: number of running tasks abandoned because of timeouts.
+        """
+
+        return dict(
+            num_items=self._queues.num_items,
+            num_running=len(self._running),
+            num_busy=self._num_busy,
+            num_responding=len(self._responding),
+            num_purged=self._num_purged,
+            num_cancelled=self._num_cancelled,
+            num_discarded=self._num_discarded,
+            num_coalesced=self._num_coalesced,
+            num_rejected=self._num_rejected,
+            num_expired=self._num_expired,
+            num_timeout=self._num_timeout,
+        )
 
-    def push(self, data: IRequestQueueData, send_message: ISend) -> str:
-        uid = random_hash()
-        self._queues.push(data.request.userId, Item(uid, data))
-        self._senders[uid] = data.request.hash, send_message
+    def push(self, data: IRequestQueueData, send_message: ISend) -> Optional[str]:
+        reason = self._admit(data)
+        if reason is not None:
+            self._num_rejected += 1
+            hash = data.request.hash
+            self._create_task(self._send_rejected(hash, send_message, reason))
+            return None
+        return self._push(random_hash(), data, send_message)
+
+    def _push(
+        self,
+        uid: str,
+        data: IRequestQueueData,
+        send_message: Optional[ISend],
+    ) -> str:
+        request = data.request
+        if self._journal is not None:
+            self._journal.push(uid, request)
+            send_message = self._make_durable(uid, send_message)
+        if send_message is None:
+            raise ValueError("`send_message` should be provided")
+        self._set_deadline(uid, request.deadline)
+        self._hashes[request.hash].add(uid)
+        if data.session_id is not None:
+            self._sessions[data.session_id].add(uid)
+        if data.plugin.settings.deterministic:
+            try:
+                data.fingerprint = get_request_fingerprint(request)
+            except Exception as err:
+                print_warning(f"failed to fingerprint request '{request.hash}' ({err})")
+        if data.fingerprint is not None:
+            subscriber = Subscriber(
+                uid,
+                uid,
+                request.hash,
+                request.userId,
+                data.session_id,
+                send_message,
+                data.event,
+            )
+            leader = self._flights.get(data.fingerprint)
+            leader_item = None if leader is None else self._items.get(leader)
+            if leader_item is not None and not leader_item.data.plugin.cancelled:
+                # identical task is in-flight, simply wait for its results
+                leader = leader_item.key
+                subscriber = subscriber._replace(leader=leader, event=asyncio.Event())
+                self._audiences[leader].append(subscriber)
+                self._subscribers[uid] = subscriber
+                # so the new subscriber will receive the position in the next broadcast
+                self._positions.pop(leader, None)
+                self._num_coalesced += 1
+                return uid
+            self._flights[data.fingerprint] = uid
+            self._audiences[uid] = [subscriber]
+            self._subscribers[uid] = subscriber
+            send_message = self._make_fan_out(uid, data.fingerprint)
+        data.plugin.send_message = send_message
+        item = Item(uid, data)
+        self._queues.push(request.userId, item)
+        self._items[uid] = item
+        self._senders[uid] = request.hash, send_message
         if DEBUG:
             print("~" * 50)
             print("> push.uid", uid)
@@ -41,42 +219,386 @@ class RequestQueue(IRequestQueue):
         return uid
 
     async def run(self) -> None:
-        if self._busy_uid is not None:
-            return
-        while True:
-            user_id, request_item = self._queues.next()
+        # there are no `await`s in this loop, so the scheduling here is 'atomic'
+        while not self._closing and self._num_busy < self.num_workers:
+            user_id, request_item = self._next()
             if user_id is None or request_item is None:
-                self._busy_uid = None
                 break
-            uid = request_item.key
-            plugin = request_item.data.plugin
-            request = request_item.data.request
-            self._busy_uid = uid
-            if DEBUG:
-                print(">>> run", uid)
+            self._num_busy += 1
+            self._running[request_item.key] = request_item.data
+            self._concurrencies[request_item.data.concurrency_key] += 1
+            task = self._create_task(self._execute(request_item))
+            self._executing.add(task)
+            task.add_done_callback(self._executing.discard)
+
+    async def _execute(self, request_item: Item[IRequestQueueData]) -> None:
+        data = request_item.data
+        batch = [request_item]
+        if data.batch_size > 1:
+            if data.batch_window > 0:
+                await asyncio.sleep(data.batch_window)
+            batch.extend(self._gather_batch(request_item))
+        if DEBUG:
+            print(">>> run", [item.key for item in batch])
+        members = []
+        for item in batch:
+            if self._journal is not None:
+                self._journal.start(item.key)
+            item.data.plugin.elapsed_times.start()
+            if await self._broadcast_working(item.key):
+                members.append(item)
+        responders: List[Tuple[Item[IRequestQueueData], Responder]] = []
+        if members:
+            timeout = data.plugin.settings.timeout
+            try:
+                responders = await asyncio.wait_for(self._process(members), timeout)
+            except asyncio.TimeoutError:
+                # the offloaded coroutine is cancelled and its worker is replaced (see
+                # `OffloadPool`), results will be discarded if it still returns
+                self._num_timeout += 1
+                message = f"task is abandoned since it exceeds the timeout ({timeout}s)"
+                for item in members:
+                    item.data.plugin.cancel()
+                    await self._broadcast_exception(item.key, message)
+            else:
+                for item in members:
+                    if item.data.plugin.cancelled:
+                        self._num_discarded += 1
+                        await self._broadcast_interrupted(item.key)
+        # the GPU (or whatever the plugin relies on) is idle when responding, so the
+        # worker is released before responding to let the next task start
+        pipeline = self._get_pipeline()
+        if not responders or pipeline is None:
+            await self._respond(responders)
+            await self._release(data)
+        else:
+            await pipeline.acquire()
+            self._responding.update(item.key for item in batch)
+            await self._release(data)
+            try:
+                await self._respond(responders)
+            finally:
+                pipeline.release()
+                self._responding.difference_update(item.key for item in batch)
+        # cleanup
+        for item in batch:
+            self._remove(item)
+        self._schedule_broadcast()
+
+    def _get_pipeline(self) -> Optional[asyncio.Semaphore]:
+        if self.pipeline_buffer <= 0:
+            return None
+        if self._pipeline is None:
+            self._pipeline = asyncio.Semaphore(self.pipeline_buffer)
+        return self._pipeline
+
+    async def _release(self, data: IRequestQueueData) -> None:
+        self._num_busy -= 1
+        self._concurrencies[data.concurrency_key] -= 1
+        await self.run()
+
+    async def _process(
+        self,
+        members: List[Item[IRequestQueueData]],
+    ) -> List[Tuple[Item[IRequestQueueData], Responder]]:
+        """
+        Run the 'process' stage of the members, and return the 'respond' stage of
+        the ones which are not cancelled.
+        """
+
+        plugin = members[0].data.plugin
+        try:
+            if members[0].data.batch_size <= 1:
+                future = plugin.execute(members[0].data.request)
+                if not plugin.settings.no_offload:
+                    future = offload(future)
+                responders = [await future]
+            else:
+                plugins = [item.data.plugin for item in members]
+                requests = [item.data.request for item in members]
+                batch_future = plugin.execute_batch(plugins, requests)
+                if not plugin.settings.no_offload:
+                    batch_future = offload(batch_future)
+                responders = await batch_future
+        except Exception as err:
+            logging.exception(f"failed to execute plugin '{plugin}'")
+            for item in members:
+                await self._broadcast_exception(item.key, get_err_msg(err))
+            return []
+        pairs = zip(members, responders)
+        return [(item, responder) for item, responder in pairs if responder is not None]
+
+    async def _respond(
+        self,
+        responders: List[Tuple[Item[IRequestQueueData], Responder]],
+    ) -> None:
+        async def _run(item: Item[IRequestQueueData], responder: Responder) -> None:
             try:
-                plugin.elapsed_times.start()
-                if await self._broadcast_working(uid):
-                    future = plugin(request)
-                    if not plugin.settings.no_offload:
-                        future = offload(future)
-                    await future
+                future = responder()
+                if not item.data.plugin.settings.no_offload:
+                    future = offload(future)
+                await future
             except Exception as err:
-                logging.exception(f"failed to execute plugin '{plugin}'")
-                await self._broadcast_exception(uid, get_err_msg(err))
-            # cleanup
-            request_item.data.event.set()
-            self._queues.remove(user_id, uid)
-            self._senders.pop(uid, None)
-            await self._broadcast_pending()
-            await asyncio.sleep(0)
-            if DEBUG:
-                print(">>> cleanup", uid)
+                logging.exception(f"failed to respond with plugin '{item.data.plugin}'")
+                await self._broadcast_exception(item.key, get_err_msg(err))
+
+        await asyncio.gather(*(_run(item, responder) for item, responder in responders))
+
+    def _gather_batch(
+        self,
+        leader: Item[IRequestQueueData],
+    ) -> List[Item[IRequestQueueData]]:
+        """
+        Gather (waiting) requests that are compatible with `leader`, in the same order
+        as they are scheduled. The gathered requests will be marked as running.
+        """
+
+        data = leader.data
+        identifier = data.plugin.identifier
+        key = data.plugin.batch_key(data.request)
+        batch: List[Item[IRequestQueueData]] = []
+        for item in list(self._iter_waiting()):
+            if len(batch) >= data.batch_size - 1:
+                break
+            if item.data.plugin.identifier != identifier:
+                continue
+            try:
+                if item.data.plugin.batch_key(item.data.request) != key:
+                    continue
+            except Exception:
+                logging.exception(f"failed to get `batch_key` of '{item.data}'")
+                continue
+            self._running[item.key] = item.data
+            self._scheduler.consume(item.data)
+            batch.append(item)
+        return batch
+
+    def _next(self) -> Tuple[Optional[str], Optional[Item[IRequestQueueData]]]:
+        """
+        Pick the next executable task. For each user, tasks are visited in order,
+        skipping the ones that are already running or whose concurrency limits are
+        reached. Then the scheduler (see `Config.scheduler`) decides which user
+        should be served, so fairness between users is preserved.
+        """
+
+        candidates: List[Item[IRequestQueueData]] = []
+        for queue_item in self._queues:
+            for request_item in queue_item.data:
+                if request_item.key in self._running:
+                    continue
+                if not self._is_available(request_item.data):
+                    continue
+                candidates.append(request_item)
+                break
+        if not candidates:
+            return None, None
+        request_item = candidates[self._scheduler.pick([c.data for c in candidates])]
+        self._scheduler.consume(request_item.data)
+        return request_item.data.request.userId, request_item
+
+    def _admit(self, data: IRequestQueueData) -> Optional[str]:
+        """return the reason if the request should be rejected, otherwise `None`"""
+
+        deadline = data.request.deadline
+        if deadline is not None and deadline <= time.time():
+            return "the deadline of the request has already passed"
+        num_waiting = self._queues.num_items - len(self._running)
+        if self.max_queue_size is not None and num_waiting >= self.max_queue_size:
+            return f"the queue is full ({num_waiting} tasks are pending)"
+        if self.max_pending_per_user is not None:
+            queue_item = self._queues.get(data.request.userId)
+            if queue_item is not None:
+                bundle = queue_item.data
+                num_user = sum(item.key not in self._running for item in bundle)
+                if num_user >= self.max_pending_per_user:
+                    return f"too many pending tasks ({num_user}) of current user"
+        if self.max_wait_time is not None:
+            wait_time = self._estimate_wait_time()
+            if wait_time > self.max_wait_time:
+                return f"the server is busy (estimated waiting time: {wait_time:.1f}s)"
+        return None
+
+    def _estimate_wait_time(self) -> float:
+        """estimate the waiting time of a new task, see `_get_schedule`"""
+
+        _, slots = self._get_schedule()
+        return max(0.0, slots[0] - time.time())
+
+    def _is_available(self, data: IRequestQueueData) -> bool:
+        if data.concurrency is None:
+            return True
+        return self._concurrencies[data.concurrency_key] < data.concurrency
+
+    def _remove(self, item: Item[IRequestQueueData]) -> None:
+        uid = item.key
+        data = item.data
+        data.event.set()
+        self._queues.remove(data.request.userId, uid)
+        self._items.pop(uid, None)
+        _discard(self._hashes, data.request.hash, uid)
+        if data.session_id is not None:
+            _discard(self._sessions, data.session_id, uid)
+        self._senders.pop(uid, None)
+        self._running.pop(uid, None)
+        self._positions.pop(uid, None)
+        self._attached.pop(uid, None)
+        self._clear_deadline(uid)
+        self._finish_journal(uid)
+        if data.fingerprint is not None:
+            if self._flights.get(data.fingerprint) == uid:
+                self._flights.pop(data.fingerprint)
+            for subscriber in self._audiences.pop(uid, []):
+                self._unsubscribe(subscriber)
+        if DEBUG:
+            print(">>> cleanup", uid)
+
+    async def cancel(self, user_id: str, hash: str) -> bool:
+        uids = self._hashes.get(hash)
+        if not uids:
+            return False
+        found = False
+        for uid in list(uids):
+            if self._get_user_id(uid) != user_id:
+                continue
+            found = True
+            subscriber = self._subscribers.get(uid)
+            target = self._detach(uid)
+            if target is None:
+                if subscriber is not None:
+                    await self._send_interrupted(subscriber.hash, subscriber.send)
+                continue
+            item = self._items.get(target)
+            if item is None:
+                continue
+            uid = target
+            if uid in self._running:
+                # the `INTERRUPTED` message will be sent after the plugin stops
+                if not item.data.plugin.cancelled:
+                    item.data.plugin.cancel()
+                    self._num_cancelled += 1
+            else:
+                await self._broadcast_interrupted(uid)
+                self._remove(item)
+                self._num_purged += 1
+        if found:
+            self._schedule_broadcast()
+        return found
+
+    def purge(self, session_id: str) -> None:
+        """
+        > If `Config.durable_queue` is enabled, the tasks will only be detached from the
+        client, so it can `attach` to them again after reconnecting. This is also
+        what happens when the app is shutting down (which disconnects all clients),
+        so the tasks can be restored after restarting.
+        """
+
+        uids = self._sessions.pop(session_id, None)
+        if not uids:
+            return
+        if self._journal is not None:
+            for uid in uids:
+                if uid in self._attached:
+                    self._attached[uid] = None
+            return
+        for uid in list(uids):
+            target = self._detach(uid)
+            if target is None:
+                continue
+            item = self._items.get(target)
+            if item is None:
+                continue
+            uid = target
+            if uid not in self._running:
+                self._remove(item)
+                self._num_purged += 1
+            elif self.cancel_on_disconnect and not item.data.plugin.cancelled:
+                item.data.plugin.cancel()
+                self._num_cancelled += 1
+        self._schedule_broadcast()
+
+    async def attach(self, user_id: str, hash: str, send_message: ISend) -> bool:
+        """
+        Re-attach a (reconnected) client to the tasks of `hash`, only take effect when
+        `Config.durable_queue` is enabled.
+        > If the tasks are already finished, their recorded final messages will be
+        sent to the client directly.
+        """
+
+        if self._journal is None:
+            return False
+        found = False
+        for uid in self._hashes.get(hash, set()):
+            if uid not in self._attached or self._get_user_id(uid) != user_id:
+                continue
+            found = True
+            self._attached[uid] = send_message
+            subscriber = self._subscribers.get(uid)
+            # so the client will receive its position in the next broadcast
+            self._positions.pop(uid if subscriber is None else subscriber.leader, None)
+        if found:
+            self._schedule_broadcast()
+            return True
+        message = await self._journal.get_result(user_id, hash)
+        if message is None:
+            return False
+        return await send_message(message)
+
+    async def restore(self, plugins: Plugins) -> int:
+        """
+        Restore the unfinished tasks from the journal, return the number of restored
+        tasks. Tasks which were running when the backend stopped will be re-run from
+        the beginning.
+        > Restored tasks have no clients attached until `attach` is called, but they
+        will be executed anyway and their results will be recorded.
+        """
+
+        if self._journal is None:
+            return 0
+        self._journal.prune(self.journal_retention)
+        loop = asyncio.get_running_loop()
+        num_restored = 0
+        for uid, request in await self._journal.unfinished():
+            identifier = request.identifier.split(".", 1)[0]  # remove hash
+            plugin = plugins.make(identifier)
+            if plugin is None:
+                message = f"plugin '{identifier}' is not found after restarting"
+                exception = ISocketMessage.make_exception(request.hash, message)
+                self._journal.record(uid, exception)
+                self._journal.finish(uid)
+                continue
+            plugin.task_hash = request.hash
+            plugin.event_loop = loop
+            plugin.elapsed_times = ElapsedTimes()
+            self._push(uid, IRequestQueueData(request, plugin), None)
+            self._create_task(self.wait(request.userId, uid))
+            num_restored += 1
+        return num_restored
+
+    async def shutdown(self, timeout: Optional[float] = None) -> None:
+        """
+        Stop scheduling new tasks, and wait (at most `timeout` seconds) for the running
+        ones to finish, including their responding stages, so their results will be
+        delivered (and recorded).
+        > If `Config.durable_queue` is enabled, the unfinished tasks (including the
+        running ones which are interrupted by the shutdown) are left unfinished in the
+        journal, so they will be restored after restarting.
+        """
+
+        self._closing = True
+        if self._executing:
+            await asyncio.wait(set(self._executing), timeout=timeout)
+        if self._journal is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._journal.close)
 
     async def wait(self, user_id: str, uid: str) -> None:
         # Maybe in some rare cases, the task completes so fast that
         # the corresponding data has already been removed.
         # So here we simply warn instead of raise.
+        subscriber = self._subscribers.get(uid)
+        if subscriber is not None and subscriber.leader != uid:
+            await subscriber.event.wait()
+            return
         queue_item = self._queues.get(user_id)
         if queue_item is None:
             print_warning("cannot find user request queue after submitted")
@@ -85,66 +607,294 @@ class RequestQueue(IRequestQueue):
         if request_item is None:
             print_warning("cannot find request item after submitted")
             return
-        await self._broadcast_pending()
-        asyncio.create_task(self.run())
+        self._schedule_broadcast()
+        self._create_task(self.run())
         await request_item.data.event.wait()
         if DEBUG:
             print("=" * 50)
             print("> finished", uid)
             print("^" * 50)
 
+    def _create_task(self, future: Coroutine[Any, Any, Any]) -> "asyncio.Task[Any]":
+        task = asyncio.create_task(future)
+        # keep a reference so the task will not be garbage collected halfway
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+
+    # deadlines
+
+    def _set_deadline(self, uid: str, deadline: Optional[float]) -> None:
+        if deadline is None:
+            return
+
+        def _expire() -> None:
+            self._deadlines.pop(uid, None)
+            self._create_task(self._expire(uid))
+
+        loop = asyncio.get_running_loop()
+        delay = max(0.0, deadline - time.time())
+        self._deadlines[uid] = loop.call_later(delay, _expire)
+
+    def _clear_deadline(self, uid: str) -> None:
+        handle = self._deadlines.pop(uid, None)
+        if handle is not None:
+            handle.cancel()
+
+    async def _expire(self, uid: str) -> None:
+        """drop the task `uid` if it is still pending, running tasks are not affected"""
+
+        subscriber = self._subscribers.get(uid)
+        leader = uid if subscriber is None else subscriber.leader
+        if leader in self._running:
+            return
+        message = "the deadline passed before the task started"
+        target = self._detach(uid)
+        if target is None:
+            if subscriber is not None:
+                await self._send_exception(subscriber.hash, subscriber.send, message)
+            self._num_expired += 1
+            return
+        item = self._items.get(target)
+        if item is None:
+            return
+        await self._broadcast_exception(target, message)
+        self._remove(item)
+        self._num_expired += 1
+        self._schedule_broadcast()
+
+    # durable queue
+
+    def _make_durable(self, uid: str, send_message: Optional[ISend]) -> ISend:
+        """
+        The final messages will be recorded, and the messages will be sent to the
+        currently attached client (see `attach`), if any.
+        """
+
+        self._attached[uid] = send_message
+
+        async def send(message: ISocketMessage) -> bool:
+            # failures caused by the shutdown are not recorded, so the tasks will be
+            # re-run after restarting
+            closing = self._closing and message.status != SocketStatus.FINISHED
+            final = message.status in FINAL_STATUSES
+            if self._journal is not None and final and not closing:
+                self._journal.record(uid, message)
+                self._recorded.add(uid)
+            attached = self._attached.get(uid)
+            # nobody is listening, but the results will be available after attaching
+            if attached is None:
+                return True
+            return await attached(message)
+
+        return send
+
+    # single-flight
+
+    def _make_fan_out(self, leader: str, fingerprint: str) -> ISend:
+        """
+        Messages of the leader task will be sent to all of its subscribers, with
+        `hash` rewritten to their own.
+        > This may be called in the offloaded threads.
+        """
+
+        async def send(message: ISocketMessage) -> bool:
+            if message.status == SocketStatus.FINISHED:
+                # new subscribers will not receive the results anymore
+                if self._flights.get(fingerprint) == leader:
+                    self._flights.pop(fingerprint, None)
+            success = False
+            for subscriber in list(self._audiences.get(leader, [])):
+                if subscriber.hash != message.hash:
+                    message = message.copy(update=dict(hash=subscriber.hash))
+                try:
+                    success = await subscriber.send(message) or success
+                except Exception:
+                    logging.exception(f"failed to send message to '{subscriber.hash}'")
+            return success
+
+        return send
+
+    def _get_user_id(self, uid: str) -> Optional[str]:
+        subscriber = self._subscribers.get(uid)
+        if subscriber is not None:
+            return subscriber.user_id
+        item = self._items.get(uid)
+        if item is None:
+            return None
+        return item.data.request.userId
+
+    def _detach(self, uid: str) -> Optional[str]:
+        """
+        Detach the subscriber `uid` from its leader task, and return `None`. However,
+        if it is the last subscriber (or the task is not `deterministic`), nothing will
+        happen and the uid of the (leader) task will be returned, which means the task
+        itself should be cancelled.
+        """
+
+        subscriber = self._subscribers.get(uid)
+        if subscriber is None:
+            return uid
+        audience = self._audiences.get(subscriber.leader, [])
+        if len(audience) <= 1:
+            return subscriber.leader
+        audience.remove(subscriber)
+        self._unsubscribe(subscriber)
+        return None
+
+    def _finish_journal(self, uid: str) -> None:
+        recorded = uid in self._recorded
+        self._recorded.discard(uid)
+        if self._journal is None:
+            return
+        # tasks interrupted by the shutdown are left unfinished, so they can be restored
+        if self._closing and not recorded:
+            return
+        self._journal.finish(uid)
+
+    def _unsubscribe(self, subscriber: Subscriber) -> None:
+        subscriber.event.set()
+        self._subscribers.pop(subscriber.uid, None)
+        self._attached.pop(subscriber.uid, None)
+        self._clear_deadline(subscriber.uid)
+        self._finish_journal(subscriber.uid)
+        _discard(self._hashes, subscriber.hash, subscriber.uid)
+        if subscriber.session_id is not None:
+            _discard(self._sessions, subscriber.session_id, subscriber.uid)
+
     # broadcast
 
+    def _iter_waiting(self) -> Iterator[Item[IRequestQueueData]]:
+        """
+        Iterate the waiting tasks in the order they are (likely to be) scheduled.
+        > This is done by simulating `_next` with a copy of the scheduler, where
+        concurrency limits are ignored.
+        """
+
+        scheduler = self._scheduler.copy()
+        queues = []
+        for queue_item in self._queues:
+            queue = deque(
+                item for item in queue_item.data if item.key not in self._running
+            )
+            if queue:
+                queues.append(queue)
+        while queues:
+            index = scheduler.pick([queue[0].data for queue in queues])
+            item = queues[index].popleft()
+            scheduler.consume(item.data)
+            yield item
+            if not queues[index]:
+                queues.pop(index)
+
+    def _estimate_duration(self, data: IRequestQueueData) -> float:
+        stats = get_elapsed_stats()
+        duration = stats.estimate(data.plugin.identifier, data.eta_condition)
+        return 0.0 if duration is None else duration
+
+    def _get_schedule(
+        self,
+    ) -> Tuple[Dict[str, Tuple[int, float, float]], List[float]]:
+        """
+        Compute the number of tasks ahead of each waiting task, together with its
+        estimated start & finish time, in one pass.
+        > Running tasks are all considered to be ahead of the waiting ones, except
+        the ones which are responding (see `Config.pipeline_buffer`).
+        > The execution is simulated with `num_workers` slots, and the execution
+        times are estimated with the historical statistics (see `ElapsedStats`).
+        Plugins which have never been executed are treated as 'free'.
+
+        Returns the schedule (uid -> (pending, start, finish)), and the times when
+        each slot will be available after all the tasks are finished (as a heap).
+        """
+
+        now = time.time()
+        slots = []
+        for uid, data in self._running.items():
+            if uid in self._responding:
+                continue
+            start = data.plugin.elapsed_times.startTime or now
+            slots.append(max(now, start + self._estimate_duration(data)))
+        heapq.heapify(slots)
+        # members of a batch share the same slot
+        while len(slots) > self.num_workers:
+            heapq.heappop(slots)
+        while len(slots) < self.num_workers:
+            heapq.heappush(slots, now)
+        offset = len(self._running) - len(self._responding)
+        schedule = {}
+        for i, item in enumerate(self._iter_waiting()):
+            start = heapq.heappop(slots)
+            finish = start + self._estimate_duration(item.data)
+            heapq.heappush(slots, finish)
+            schedule[item.key] = offset + i, start, finish
+        return schedule, slots
+
+    def _schedule_broadcast(self) -> None:
+        """
+        Queue changes happened within `broadcast_interval` seconds will be
+        broadcasted together.
+        """
+
+        if self._broadcast_handle is not None:
+            return
+
+        def _broadcast() -> None:
+            self._broadcast_handle = None
+            self._create_task(self._broadcast_pending())
+
+        loop = asyncio.get_running_loop()
+        self._broadcast_handle = loop.call_later(self.broadcast_interval, _broadcast)
+
     async def _broadcast_pending(self) -> None:
-        for uid, (hash, sender) in self._senders.items():
-            if uid == self._busy_uid:
+        total = self._queues.num_items
+        schedule, _ = self._get_schedule()
+        futures = []
+        for uid, (pending, start, finish) in schedule.items():
+            # only broadcast to the clients whose positions actually changed
+            if self._positions.get(uid) == pending:
                 continue
-            pending = self._queues.get_pending(uid)
-            if DEBUG:
-                print("-" * 50)
-                print(">> uid", uid)
-                print(">> hash", hash)
-                print(
-                    ">> queues\n\n",
-                    "\n".join(
-                        [
-                            f"{queue_item.key} : "
-                            + ", ".join(
-                                [
-                                    getattr(item.data.request, "hash", "None")
-                                    for item in queue_item.data
-                                ]
-                            )
-                            for queue_item in self._queues
-                        ]
-                    ),
-                    "\n",
+            self._positions[uid] = pending
+            if pending <= 0:
+                continue
+            sender_pack = self._senders.get(uid)
+            if sender_pack is None:
+                continue
+            estimated = EstimatedTimes(startTime=start, finishTime=finish)
+            pack = *sender_pack, total, pending, estimated
+            futures.append(self._send_pending(*pack))
+        if DEBUG:
+            print("-" * 50)
+            print(">> schedule", schedule)
+            print(">> broadcasting to", len(futures), "clients")
+        await asyncio.gather(*futures)
+
+    async def _send_pending(
+        self,
+        hash: str,
+        sender: ISend,
+        total: int,
+        pending: int,
+        estimated: EstimatedTimes,
+    ) -> None:
+        prefix = f"[broadcast_pending] [{hash}]"
+        success = True
+        message = prefix
+        try:
+            success = await sender(
+                ISocketMessage(
+                    hash=hash,
+                    status=SocketStatus.PENDING,
+                    total=total,
+                    pending=pending,
+                    message=message,
+                    data=ISocketResponse(estimatedTimes=estimated),
                 )
-            prefix = f"[broadcast_pending] [{hash}]"
-            success = True
-            message = "null"
-            try:
-                if pending is None:
-                    message = (
-                        f"{prefix} Internal error occurred: "
-                        "cannot find pending request after submitted"
-                    )
-                    success = await sender(ISocketMessage.make_exception(hash, message))
-                elif len(pending) > 0:
-                    message = prefix
-                    success = await sender(
-                        ISocketMessage(
-                            hash=hash,
-                            status=SocketStatus.PENDING,
-                            total=self._queues.num_items,
-                            pending=len(pending),
-                            message=message,
-                        )
-                    )
-            except Exception:
-                logging.exception(f"{prefix} failed to send message '{message}'")
-            if not success:
-                print_error(f"Failed to send following message: {message}")
+            )
+        except Exception:
+            logging.exception(f"{prefix} failed to send message '{message}'")
+        if not success:
+            print_error(f"Failed to send following message: {message}")
 
     async def _broadcast_working(self, uid: str) -> bool:
         sender_pack = self._senders.get(uid)
@@ -170,12 +920,36 @@ class RequestQueue(IRequestQueue):
             print_error(f"Failed to send following message: {message}")
         return success
 
+    async def _broadcast_interrupted(self, uid: str) -> bool:
+        sender_pack = self._senders.get(uid)
+        if sender_pack is None:
+            return False
+        return await self._send_interrupted(*sender_pack)
+
+    async def _send_interrupted(self, hash: str, sender: ISend) -> bool:
+        message = f"[broadcast_interrupted] [{hash}] task is cancelled"
+        try:
+            # the client may have already disconnected, so failures are expected here
+            return await sender(ISocketMessage.make_interrupted(hash, message))
+        except Exception:
+            return False
+
+    async def _send_rejected(self, hash: str, sender: ISend, reason: str) -> bool:
+        message = f"[rejected] [{hash}] {reason}"
+        try:
+            return await sender(ISocketMessage.make_rejected(hash, message))
+        except Exception:
+            logging.exception(f"failed to send message '{message}'")
+            return False
+
     async def _broadcast_exception(self, uid: str, message: str) -> bool:
         logging.exception(message)
         sender_pack = self._senders.get(uid)
         if sender_pack is None:
             return False
-        hash, sender = sender_pack
+        return await self._send_exception(*sender_pack, message)
+
+    async def _send_exception(self, hash: str, sender: ISend, message: str) -> bool:
         prefix = f"[broadcast_exception] [{hash}]"
         success = True
         try:
@@ -188,6 +962,14 @@ class RequestQueue(IRequestQueue):
         return success
 
 
+def _discard(index: Dict[str, Set[str]], key: str, uid: str) -> None:
+    uids = index.get(key)
+    if uids is not None:
+        uids.discard(uid)
+        if not uids:
+            index.pop(key)
+
+
 __all__ = [
     "RequestQueue",
 ]
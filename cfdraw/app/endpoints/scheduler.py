@@ -0,0 +1,94 @@
+from typing import Dict
+from typing import List
+from typing import Type
+from typing import Callable
+
+from cfdraw.config import Config
+from cfdraw.app.schema import IScheduler
+from cfdraw.app.schema import IRequestQueueData
+
+
+TScheduler = Type[IScheduler]
+schedulers: Dict[str, TScheduler] = {}
+
+
+def register_scheduler(name: str) -> Callable[[TScheduler], TScheduler]:
+    def _register(scheduler_type: TScheduler) -> TScheduler:
+        if name in schedulers:
+            raise ValueError(f"scheduler '{name}' already exists")
+        schedulers[name] = scheduler_type
+        return scheduler_type
+
+    return _register
+
+
+def make_scheduler(config: Config) -> IScheduler:
+    scheduler_type = schedulers.get(config.scheduler)
+    if scheduler_type is None:
+        raise ValueError(
+            f"unrecognized scheduler '{config.scheduler}' occurred, "
+            f"available schedulers are: {', '.join(schedulers)}"
+        )
+    return scheduler_type(config)
+
+
+@register_scheduler("weighted_fair")
+class WeightedFairScheduler(IScheduler):
+    """
+    Start-time fair queuing between users: each user has a virtual finish time,
+    which advances by `cost / weight` every time one of its tasks is executed, and
+    the user with the smallest virtual start time will be served first.
+    > `cost` is the estimated cost of the task (see `IRequestQueueData.cost`), so
+    users share the execution time rather than the number of tasks.
+    > `weight` is determined by the priority tier of the user (see
+    `Config.priority_tiers`), so users of higher tiers get larger shares.
+    """
+
+    def __init__(self, config: Config) -> None:
+        self.priority_tiers = config.priority_tiers
+        self._vtime = 0.0
+        self._finish: Dict[str, float] = {}
+
+    def pick(self, candidates: List[IRequestQueueData]) -> int:
+        starts = [self._get_start(data.request.userId) for data in candidates]
+        return starts.index(min(starts))
+
+    def consume(self, data: IRequestQueueData) -> None:
+        user_id = data.request.userId
+        start = self._get_start(user_id)
+        self._vtime = max(self._vtime, start)
+        self._finish[user_id] = start + self.get_cost(data) / self.get_weight(data)
+        # users who are 'behind' the virtual time are equivalent to new users
+        for user_id, finish in list(self._finish.items()):
+            if finish <= self._vtime:
+                self._finish.pop(user_id)
+
+    def get_cost(self, data: IRequestQueueData) -> float:
+        return data.cost
+
+    def get_weight(self, data: IRequestQueueData) -> float:
+        if data.tier is None:
+            return 1.0
+        return max(self.priority_tiers.get(data.tier, 1.0), 1.0e-6)
+
+    def _get_start(self, user_id: str) -> float:
+        return max(self._vtime, self._finish.get(user_id, self._vtime))
+
+
+@register_scheduler("round_robin")
+class RoundRobinScheduler(WeightedFairScheduler):
+    """Serve the users in turn, regardless of the costs of their tasks."""
+
+    def get_cost(self, data: IRequestQueueData) -> float:
+        return 1.0
+
+    def get_weight(self, data: IRequestQueueData) -> float:
+        return 1.0
+
+
+__all__ = [
+    "register_scheduler",
+    "make_scheduler",
+    "WeightedFairScheduler",
+    "RoundRobinScheduler",
+]
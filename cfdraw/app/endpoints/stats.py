@@ -0,0 +1,51 @@
+import json
+
+from typing import Any
+from typing import Dict
+from cftool.misc import print_info
+
+from cfdraw import constants
+from cfdraw.utils.misc import get_offload_pool
+from cfdraw.utils.stats import get_elapsed_stats
+from cfdraw.utils.server import get_hot_images
+from cfdraw.utils.server import get_result_cache
+from cfdraw.utils.server import get_decoded_image_cache
+from cfdraw.utils.remote import get_remote_fetcher
+from cfdraw.utils.storage import get_image_storage
+from cfdraw.utils.renditions import get_rendition_cache
+from cfdraw.app.endpoints.base import IEndpoint
+
+
+class StatsEndpoint(IEndpoint):
+    """
+    Expose the instrumentations of the queue, the pools & the caches (e.g., how many
+    tasks are purged / cancelled before wasting any work, cache hits & misses).
+    > They will also be printed when the app is shutting down.
+    """
+
+    async def get_stats(self) -> Dict[str, Any]:
+        return dict(
+            queue=self.app.request_queue.stats,
+            fast_lane=self.app.fast_lane.stats,
+            offload_pool=get_offload_pool().stats,
+            result_cache=get_result_cache().stats,
+            decoded_image_cache=get_decoded_image_cache().stats,
+            rendition_cache=get_rendition_cache().stats,
+            hot_images=get_hot_images().stats,
+            remote=get_remote_fetcher().stats,
+            elapsed=get_elapsed_stats().stats,
+            storage=await get_image_storage().index.get_stats(),
+        )
+
+    def register(self) -> None:
+        @self.app.api.get(str(constants.Endpoint.STATS))
+        async def stats() -> Dict[str, Any]:
+            return await self.get_stats()
+
+    async def on_shutdown(self) -> None:
+        print_info(f"📊 Stats: {json.dumps(await self.get_stats())}")
+
+
+__all__ = [
+    "StatsEndpoint",
+]
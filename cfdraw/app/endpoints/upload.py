@@ -12,16 +12,20 @@ from fastapi import Response
 from fastapi import UploadFile
 from pydantic import BaseModel
 from PIL.PngImagePlugin import PngInfo
+from cftool.web import raise_err
 from cftool.web import get_responses
 from cftool.web import get_image_response_kwargs
 from cftool.misc import get_err_msg
 
 from cfdraw import constants
 from cfdraw.app.schema import IApp
+from cfdraw.schema.plugins import ImageEncoding
 from cfdraw.utils.server import save_svg
 from cfdraw.utils.server import save_image
-from cfdraw.utils.server import get_svg_response
+from cfdraw.utils.server import get_file_response
 from cfdraw.utils.server import get_image_response
+from cfdraw.utils.server import get_jpeg_rendition
+from cfdraw.utils.server import get_stored_file_response
 from cfdraw.app.endpoints.base import IEndpoint
 
 
@@ -60,28 +64,37 @@ class ImageUploader:
         base_url: str,
         is_svg: bool,
         audit: bool,
+        encoding: Optional[ImageEncoding] = None,
     ) -> ImageDataModel:
         """
         When this method is used in the:
         * `upload_image` endpoint, `contents` will be a `bytes` object.
-        * `FieldsMiddleware`, `contents` will be an `Image.Image` object.
+        * `ResponseMiddleware`, `contents` will be an `Image.Image` object.
+
+        > The image will be encoded in the shared encoding pool (see `offload_encode`),
+        so multiple images can be uploaded in parallel.
+        > The image will be stored in the configured storage backend (see
+        `Config.storage_backend`).
+        > `encoding` specifies how the image is encoded, `Config.image_encoding` will be
+        used if not provided. The `upload_image` endpoint always uses PNG, so user
+        uploads (e.g., masks, transparent stickers) will not lose anything.
         """
 
         if is_svg:
             if isinstance(contents, Image.Image):
                 raise ValueError("svg image should be uploaded as bytes")
-            return ImageDataModel(**save_svg(contents.decode(), base_url))
+            return ImageDataModel(**await save_svg(contents.decode(), base_url))
         meta.add_text("userJson", userJson)
         if isinstance(contents, Image.Image):
             image = contents
         else:
             image = Image.open(BytesIO(contents))
-        return ImageDataModel(**save_image(image, meta, base_url))
+        return ImageDataModel(**await save_image(image, meta, base_url, encoding))
 
     @staticmethod
     async def fetch_image(data: FetchImageModel) -> Union[Response, Image.Image]:
         file = data.url.split(constants.UPLOAD_IMAGE_FOLDER_NAME)[1][1:]  # remove '/'
-        return get_image_response(file, data.jpeg, data.return_image)
+        return await get_image_response(file, data.jpeg, data.return_image)
 
 
 def add_upload_image(app: IApp) -> None:
@@ -101,7 +114,9 @@ def add_upload_image(app: IApp) -> None:
             if userJson is None:
                 userJson = json.dumps(dict(userId=userId))
             is_svg = isSVG == "1"
-            args = contents, userJson, PngInfo(), base_url, is_svg, audit
+            # `Config.image_encoding` is for the images returned by the plugins
+            encoding = ImageEncoding()
+            args = contents, userJson, PngInfo(), base_url, is_svg, audit, encoding
             data = await ImageUploader.upload_image(*args)
         except Exception as err:
             logging.exception("failed to upload image")
@@ -119,10 +134,14 @@ def add_upload_image(app: IApp) -> None:
         f"/{constants.UPLOAD_IMAGE_FOLDER_NAME}/{{file}}/",
         **get_image_response_kwargs(),
     )
-    async def get_image(file: str, jpeg: bool = False) -> Response:
-        if file.endswith(".svg"):
-            return get_svg_response(file)
-        return get_image_response(file, jpeg)
+    async def get_image(file: str, jpeg: bool = False, *, request: Request) -> Response:
+        if jpeg and not file.endswith(".svg"):
+            try:
+                path = await get_jpeg_rendition(file)
+            except Exception as err:
+                raise_err(err)
+            return get_file_response(path, request.headers)
+        return await get_stored_file_response(file, request.headers)
 
 
 class UploadEndpoint(IEndpoint):
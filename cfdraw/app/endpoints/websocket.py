@@ -6,15 +6,21 @@ from fastapi import WebSocket
 from fastapi import WebSocketDisconnect
 from cftool.misc import get_err_msg
 from cftool.misc import print_error
+from cftool.misc import random_hash
 from starlette.websockets import WebSocketState
 
 from cfdraw import constants
 from cfdraw.app.schema import IApp
 from cfdraw.app.schema import IRequestQueueData
 from cfdraw.utils.misc import offload
+from cfdraw.utils.remote import get_remote_sources
+from cfdraw.utils.remote import get_remote_fetcher
+from cfdraw.schema.plugins import PluginLane
 from cfdraw.schema.plugins import ElapsedTimes
 from cfdraw.schema.plugins import ISocketRequest
 from cfdraw.schema.plugins import ISocketMessage
+from cfdraw.schema.plugins import ISocketCancelRequest
+from cfdraw.schema.plugins import ISocketAttachRequest
 from cfdraw.app.endpoints.base import IEndpoint
 
 
@@ -38,53 +44,90 @@ def add_websocket(app: IApp) -> None:
             await websocket.send_text(json.dumps(data.dict()))
             return True
 
+        session_id = random_hash()
         await websocket.accept()
-        while True:
-            raw_data = data = None
-            try:
-                target_plugin = None
-                raw_data = await websocket.receive_text()
-                data = ISocketRequest(**json.loads(raw_data))
-                if data.isInternal:
-                    identifier = data.identifier
-                    target_plugin = app.internal_plugins.make(identifier)
-                else:
-                    identifier = data.identifier.split(".", 1)[0]  # remove hash
-                    target_plugin = app.plugins.make(identifier)
-                if target_plugin is not None:
-                    # `send_message` should be handled by the plugin itself, or by
-                    # the `SendSocketMessageMiddleware` which will provide a default handling
-                    target_plugin.task_hash = data.hash
-                    target_plugin.send_message = send_message
-                    target_plugin.elapsed_times = ElapsedTimes()
+        # the session should always be purged, even if the loop exits unexpectedly
+        # (e.g., `on_failed` fails on a dead socket), or its tasks will be kept
+        try:
+            while True:
+                raw_data = data = None
+                try:
+                    target_plugin = None
+                    raw_data = await websocket.receive_text()
+                    json_data = json.loads(raw_data)
+                    if json_data.get("type") == "cancel":
+                        cancel = ISocketCancelRequest(**json_data)
+                        await app.request_queue.cancel(cancel.userId, cancel.hash)
+                        continue
+                    if json_data.get("type") == "attach":
+                        attach = ISocketAttachRequest(**json_data)
+                        found = await app.request_queue.attach(
+                            attach.userId,
+                            attach.hash,
+                            send_message,
+                        )
+                        # let the client know that it should not wait for the results
+                        if not found:
+                            message = (
+                                f"task '{attach.hash}' is lost after disconnecting"
+                            )
+                            lost = ISocketMessage.make_interrupted(attach.hash, message)
+                            await send_message(lost)
+                        continue
+                    data = ISocketRequest(**json_data)
                     if data.isInternal:
-                        target_plugin.elapsed_times.start()
-                        await offload(target_plugin(data))
+                        identifier = data.identifier
+                        target_plugin = app.internal_plugins.make(identifier)
                     else:
-                        queue_data = IRequestQueueData(data, target_plugin)
-                        uid = app.request_queue.push(queue_data, send_message)
-                        asyncio.create_task(app.request_queue.wait(data.userId, uid))
-                else:
-                    plugin_str = "internal plugin" if data.isInternal else "plugin"
-                    message = (
-                        f"incoming message subscribed {plugin_str} '{identifier}', "
-                        "but it is not found"
-                    )
-                    exception = ISocketMessage.make_exception(data.hash, message)
-                    if not await send_message(exception):
-                        print_error(f"[websocket.loop] {message}")
-            except WebSocketDisconnect:
-                break
-            except Exception as e:
-                if data is not None:
-                    req_hash = data.hash
-                elif raw_data is not None and isinstance(raw_data, dict):
-                    req_hash = raw_data.get("hash", "unknown")
-                else:
-                    req_hash = "unknown"
-                await on_failed(e, req_hash)
-            finally:
-                del target_plugin
+                        identifier = data.identifier.split(".", 1)[0]  # remove hash
+                        target_plugin = app.plugins.make(identifier)
+                    if target_plugin is not None:
+                        # `send_message` should be handled by the plugin itself, or by
+                        # the `SendSocketMessageMiddleware` which will provide a default handling
+                        target_plugin.task_hash = data.hash
+                        target_plugin.event_loop = asyncio.get_running_loop()
+                        target_plugin.send_message = send_message
+                        target_plugin.elapsed_times = ElapsedTimes()
+                        if data.isInternal:
+                            target_plugin.elapsed_times.start()
+                            await offload(target_plugin(data))
+                        elif target_plugin.settings.resolved_lane == PluginLane.FAST:
+                            app.fast_lane.submit(target_plugin, data)
+                        else:
+                            queue_data = IRequestQueueData(
+                                data, target_plugin, session_id
+                            )
+                            uid = app.request_queue.push(queue_data, send_message)
+                            if uid is not None:
+                                # only the admitted requests prefetch their images
+                                if target_plugin.settings.consumes_images:
+                                    sources = get_remote_sources(data)
+                                    get_remote_fetcher().prefetch(sources)
+                                wait = app.request_queue.wait(data.userId, uid)
+                                asyncio.create_task(wait)
+                    else:
+                        plugin_str = "internal plugin" if data.isInternal else "plugin"
+                        message = (
+                            f"incoming message subscribed {plugin_str} '{identifier}', "
+                            "but it is not found"
+                        )
+                        exception = ISocketMessage.make_exception(data.hash, message)
+                        if not await send_message(exception):
+                            print_error(f"[websocket.loop] {message}")
+                except WebSocketDisconnect:
+                    break
+                except Exception as e:
+                    if data is not None:
+                        req_hash = data.hash
+                    elif raw_data is not None and isinstance(raw_data, dict):
+                        req_hash = raw_data.get("hash", "unknown")
+                    else:
+                        req_hash = "unknown"
+                    await on_failed(e, req_hash)
+                finally:
+                    del target_plugin
+        finally:
+            app.request_queue.purge(session_id)
 
 
 class WebsocketEndpoint(IEndpoint):
@@ -1,10 +1,19 @@
+import copy
+import json
+
 from abc import abstractmethod
 from abc import ABC
 from aiohttp import ClientSession
 from asyncio import Event
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
 from fastapi import FastAPI
 
 from cfdraw.config import Config
+from cfdraw.utils.stats import get_condition
+from cfdraw.utils.stats import get_elapsed_stats
 from cfdraw.schema.plugins import ISend
 from cfdraw.schema.plugins import IPlugin
 from cfdraw.schema.plugins import ISocketRequest
@@ -12,22 +21,80 @@ from cfdraw.plugins.factory import Plugins
 
 
 class IRequestQueueData:
-    def __init__(self, request: ISocketRequest, plugin: IPlugin):
+    def __init__(
+        self,
+        request: ISocketRequest,
+        plugin: IPlugin,
+        session_id: Optional[str] = None,
+    ):
         self.request = request
         self.plugin = plugin
+        self.session_id = session_id
         self.event = Event()
+        settings = plugin.settings
+        self.concurrency = settings.concurrency
+        self.concurrency_key = settings.concurrency_group or plugin.identifier
+        self.batch_size = settings.batch_size or 1
+        self.batch_window = settings.batch_window / 1000
+        self.eta_condition = get_condition(request.extraData, settings.eta_keys)
+        self.cost = settings.cost or self._estimate_cost()
+        self.tier = self._get_tier()
+        ## will be set by the queue if the plugin is `deterministic`
+        self.fingerprint: Optional[str] = None
 
     def __str__(self) -> str:
         return self.request.identifier.split(".")[0]
 
     __repr__ = __str__
 
+    def _estimate_cost(self) -> float:
+        stats = get_elapsed_stats()
+        cost = stats.estimate(self.plugin.identifier, self.eta_condition)
+        # plugins which have never been executed are assumed to take 1 second
+        return 1.0 if cost is None else cost
+
+    def _get_tier(self) -> Optional[str]:
+        try:
+            tier = json.loads(self.request.get_user_json()).get("tier")
+        except Exception:
+            return None
+        return None if tier is None else str(tier)
+
+
+class IScheduler(ABC):
+    """Decides which user should be served next by the `RequestQueue`."""
+
+    @abstractmethod
+    def __init__(self, config: Config) -> None:
+        pass
+
+    @abstractmethod
+    def pick(self, candidates: List[IRequestQueueData]) -> int:
+        """
+        Return the index of the task to be executed next, `candidates` are the first
+        executable tasks of each user. This method should not modify the states.
+        """
+
+    @abstractmethod
+    def consume(self, data: IRequestQueueData) -> None:
+        """Called when the task `data` is going to be executed."""
+
+    def copy(self) -> "IScheduler":
+        """Used for simulations, e.g. predicting the positions of the tasks."""
+
+        return copy.deepcopy(self)
+
 
 class IRequestQueue(ABC):
+    @property
     @abstractmethod
-    def push(self, data: IRequestQueueData, send_message: ISend) -> str:
+    def stats(self) -> Dict[str, Any]:
         pass
 
+    @abstractmethod
+    def push(self, data: IRequestQueueData, send_message: ISend) -> Optional[str]:
+        """return the uid of the task, or `None` if the request is rejected"""
+
     @abstractmethod
     async def run(self) -> None:
         pass
@@ -36,12 +103,51 @@ class IRequestQueue(ABC):
     async def wait(self, user_id: str, uid: str) -> None:
         pass
 
+    @abstractmethod
+    async def cancel(self, user_id: str, hash: str) -> bool:
+        """cancel the tasks of `hash`, return whether any task is found"""
+
+    @abstractmethod
+    def purge(self, session_id: str) -> None:
+        """called when the client (websocket session) of `session_id` is disconnected"""
+
+    @abstractmethod
+    async def attach(self, user_id: str, hash: str, send_message: ISend) -> bool:
+        """re-attach a client to the tasks of `hash`, return whether any task is found"""
+
+    @abstractmethod
+    async def restore(self, plugins: Plugins) -> int:
+        """restore the unfinished tasks (if any), return the number of restored tasks"""
+
+    @abstractmethod
+    async def shutdown(self, timeout: Optional[float] = None) -> None:
+        """
+        Called when the app is shutting down, should wait (at most `timeout` seconds)
+        for the running tasks to finish.
+        """
+
+
+class IFastLane(ABC):
+    @property
+    @abstractmethod
+    def stats(self) -> Dict[str, Any]:
+        pass
+
+    @abstractmethod
+    def submit(self, plugin: IPlugin, request: ISocketRequest) -> None:
+        pass
+
+    @abstractmethod
+    def shutdown(self, timeout: Optional[float] = None) -> None:
+        pass
+
 
 class IApp(ABC):
     api: FastAPI
     config: Config
     http_session: ClientSession
     request_queue: IRequestQueue
+    fast_lane: IFastLane
 
     @property
     @abstractmethod
@@ -1,5 +1,6 @@
 import os
 
+from typing import Dict
 from typing import Optional
 from pathlib import Path
 from importlib import import_module
@@ -9,6 +10,7 @@ from dataclasses import dataclass
 from cfdraw import constants
 from cfdraw.utils.cache import cache_resource
 from cfdraw.schema.settings import ExtraPlugins
+from cfdraw.schema.plugins import ImageEncoding
 from cfdraw.schema.settings import BoardSettings
 
 
@@ -24,10 +26,124 @@ class Config:
     backend_hosting_url: Optional[str] = None
     # upload
     upload_root: str = field(default_factory=constants.get_upload_root)
+    ## default encoding of the images returned by the plugins, can be overridden by
+    ## `image_encoding` of `IPluginSettings`
+    image_encoding: ImageEncoding = field(default_factory=ImageEncoding)
+    ## whether to return the urls of the new images before they are encoded & stored,
+    ## they will be kept in memory (and served from there) until persisted in the
+    ## background, so the clients & the following plugins do not need to wait
+    defer_image_persistence: bool = False
+    ## maximum size (bytes) of the cached renditions (e.g., the JPEG versions) of the
+    ## stored images, least recently used ones will be removed when exceeded
+    rendition_cache_size: int = 512 * 1024 * 1024
+    ## where the uploaded / generated images are stored, `local` or `s3`
+    ## > custom backends can be registered by `register_storage_backend`
+    storage_backend: str = "local"
+    ## settings of the `s3` backend, any S3-compatible object storage can be used
+    s3_endpoint: Optional[str] = None
+    s3_bucket: Optional[str] = None
+    s3_prefix: str = ""
+    s3_region: str = "us-east-1"
+    s3_access_key: Optional[str] = None
+    s3_secret_key: Optional[str] = None
+    ## maximum number of pooled connections (per event loop)
+    s3_max_connections: int = 32
+    ## connect / read timeout (seconds) of the s3 requests
+    s3_timeout: float = 30.0
+    # remote
+    ## connection pool of the shared `http_session`, the remote images (e.g., images
+    ## pasted from other sites) in `load_image` are fetched with a pool of the same size
+    http_max_connections: int = 100
+    http_max_connections_per_host: int = 16
+    ## connect / total timeout (seconds) of the requests of the shared `http_session`
+    http_connect_timeout: float = 30.0
+    http_timeout: float = 300.0
+    ## total timeout (seconds) of fetching a remote image, including the retries
+    remote_fetch_timeout: float = 30.0
+    ## number of retries (with exponential backoff) when fetching a remote image fails
+    ## because of connection errors, timeouts or `429` / `5xx` responses
+    remote_fetch_retries: int = 2
+    ## maximum size (bytes) of a remote image, larger ones (or non-image responses)
+    ## will be rejected without being fully downloaded
+    remote_max_size: int = 32 * 1024 * 1024
+    ## maximum size (bytes) of the remote images cached on disk
+    remote_cache_size: int = 256 * 1024 * 1024
+    ## cached remote images are considered fresh for at least this long (seconds),
+    ## after that they will be revalidated with their `ETag` / `Last-Modified`
+    remote_cache_min_ttl: int = 60
+    ## maximum number of remote images of a request that can be prefetched at the same
+    ## time, remote sources of the requests are prefetched when they are received
+    remote_prefetch_concurrency: int = 4
+    ## whether remote images can be fetched from private / loopback / link-local
+    ## addresses, this should only be enabled if all the users are trusted, because
+    ## the image sources come from the clients
+    remote_allow_private_hosts: bool = False
     # board
     board_settings: BoardSettings = field(default_factory=BoardSettings)
     # extra plugins
     extra_plugins: ExtraPlugins = field(default_factory=ExtraPlugins)
+    # queue
+    ## number of tasks that can be executed concurrently
+    ## > per-plugin limits can be further specified by `IPluginSettings.concurrency`
+    num_workers: int = 1
+    ## number of long-lived threads used to `offload` plugins, if not provided,
+    ## it will be `num_workers` plus a few more threads for the internal plugins
+    offload_workers: Optional[int] = None
+    ## changes of the queue happened within this interval (ms) will be broadcasted
+    ## to the clients (as `PENDING` messages) together
+    pending_broadcast_interval: int = 200
+    ## admission control, new tasks will be rejected (with a `REJECTED` message) when:
+    ## * there are already `max_queue_size` pending tasks in the queue
+    ## * the user already has `max_pending_per_user` pending tasks
+    ## * the estimated waiting time (seconds) exceeds `max_wait_time`
+    ## > `None` means no limit
+    max_queue_size: Optional[int] = None
+    max_pending_per_user: Optional[int] = None
+    max_wait_time: Optional[float] = None
+    ## policy to decide which user should be served next, available policies are:
+    ## * round_robin: users are served in turn
+    ## * weighted_fair: users share the (estimated) execution time, weighted by their
+    ## priority tiers, see `IPluginSettings.cost` & `priority_tiers`
+    ## > custom policies can be registered by `register_scheduler`
+    scheduler: str = "round_robin"
+    ## weights of the priority tiers, the tier of a user is read from the `tier` field
+    ## of the `userJson`, users without (known) tiers will have weight 1
+    priority_tiers: Dict[str, float] = field(default_factory=dict)
+    ## whether to cancel the running tasks when their clients are disconnected
+    ## > pending tasks of disconnected clients will always be purged from the queue
+    cancel_on_disconnect: bool = True
+    ## maximum number of tasks that can be responding (encoding / uploading the results
+    ## and sending the final messages) after their workers are released
+    ## > the workers will move on to the next tasks in the meantime, and will wait
+    ## for a free buffer slot if the buffer is full
+    ## > set to `0` to respond within the workers
+    pipeline_buffer: int = 2
+    ## number of threads used to execute the plugins in the fast lane
+    ## > see `PluginLane` for more details
+    fast_lane_workers: int = 4
+    ## whether to journal the tasks to `queue.sqlite` under the project folder,
+    ## so unfinished tasks can be restored after the backend restarts
+    durable_queue: bool = False
+    ## finished tasks will be kept in the journal for this long (seconds), so
+    ## reconnecting clients can still fetch their results
+    durable_queue_retention: int = 86400
+    ## when the app is shutting down, the running tasks (including their responding
+    ## stages) will be waited for at most this long (seconds) in total, and the ones
+    ## that have not started will be dropped
+    shutdown_timeout: float = 30.0
+    # plugins
+    ## minimum interval (ms) between two progress messages of the same task
+    progress_interval: int = 100
+    ## maximum number of results of the `deterministic` plugins that will be cached
+    result_cache_size: int = 256
+    ## time-to-live (seconds) of the cached results, `None` means no expiration
+    result_cache_ttl: Optional[int] = 3600
+    ## maximum size (bytes) of the decoded images cached by `load_image`, so chained
+    ## plugins will not decode the same image again and again
+    decoded_image_cache_size: int = 512 * 1024 * 1024
+    ## number of threads used to encode & save the images returned by the plugins,
+    ## `None` means `min(8, os.cpu_count())`
+    encode_workers: Optional[int] = None
     # misc
     use_react_strict_mode: bool = False
 
@@ -59,6 +175,18 @@ class Config:
     def frontend_url(self) -> str:
         return f"http://localhost:{self.frontend_port}"
 
+    @property
+    def num_offload_workers(self) -> int:
+        if self.offload_workers is not None:
+            return self.offload_workers
+        return self.num_workers + self.pipeline_buffer + 4
+
+    @property
+    def num_encode_workers(self) -> int:
+        if self.encode_workers is not None:
+            return self.encode_workers
+        return min(8, os.cpu_count() or 1)
+
     @property
     def upload_root_path(self) -> Path:
         return Path(self.upload_root).absolute()
@@ -69,6 +197,18 @@ class Config:
         folder.mkdir(parents=True, exist_ok=True)
         return folder
 
+    @property
+    def upload_rendition_folder(self) -> Path:
+        folder = self.upload_root_path / constants.UPLOAD_RENDITION_FOLDER_NAME
+        folder.mkdir(parents=True, exist_ok=True)
+        return folder
+
+    @property
+    def upload_remote_folder(self) -> Path:
+        folder = self.upload_root_path / constants.UPLOAD_REMOTE_FOLDER_NAME
+        folder.mkdir(parents=True, exist_ok=True)
+        return folder
+
     @property
     def upload_project_folder(self) -> Path:
         folder = self.upload_root_path / constants.UPLOAD_PROJECT_FOLDER_NAME
@@ -24,6 +24,7 @@ API_URL_KEY = "CFDRAW_API_URL"
 class Endpoint(Enum):
     PING = "ping"
     WEBSOCKET = "ws"
+    STATS = "stats"
 
     def __str__(self) -> str:
         return f"/{self.value}"
@@ -78,6 +79,8 @@ WEB_ROOT = ROOT / ".web"
 UPLOAD_ROOT = Path("~").expanduser() / ".cache" / "carefree-drawboard" / "_upload"
 UPLOAD_IMAGE_FOLDER_NAME = ".images"
 UPLOAD_PROJECT_FOLDER_NAME = ".projects"
+UPLOAD_RENDITION_FOLDER_NAME = ".renditions"
+UPLOAD_REMOTE_FOLDER_NAME = ".remote"
 BUGGY_PROJECT_FOLDER = ".buggy"
 PROJECT_META_FILE = "_meta.json"
 
@@ -1,3 +1,5 @@
+import json
+
 from abc import abstractmethod
 from abc import ABCMeta
 from PIL import Image
@@ -5,12 +7,19 @@ from typing import Any
 from typing import Dict
 from typing import List
 from typing import Optional
+from typing import Hashable
+from cftool.misc import print_warning
 from cftool.misc import shallow_copy_dict
 from cftool.data_structures import Workflow
 
 from cfdraw import constants
 from cfdraw.utils import server
-from cfdraw.utils.misc import offload_run
+from cfdraw.config import get_config
+from cfdraw.utils.misc import ThrottledSender
+from cfdraw.utils.server import get_result_cache
+from cfdraw.utils.server import get_request_fingerprint
+from cfdraw.utils.remote import is_remote_url
+from cfdraw.utils.remote import get_remote_image
 from cfdraw.schema.plugins import *
 from cfdraw.plugins.middlewares import *
 from cfdraw.parsers.noli import SingleNodeType
@@ -19,10 +28,38 @@ from cfdraw.app.endpoints.upload import FetchImageModel
 
 
 class ISocketPlugin(IPlugin, metaclass=ABCMeta):
+    progress_sender: ThrottledSender[ISocketMessage]
+    ## will be set when the plugin is processing a batch of requests (see `execute_batch`)
+    batch_plugins: Optional[List["ISocketPlugin"]] = None
+    _cancelled: bool = False
+    ## will be set when the plugin is `deterministic` (see `IPluginSettings`)
+    _fingerprint: Optional[str] = None
+
     @abstractmethod
     async def process(self, data: ISocketRequest) -> Any:
         pass
 
+    # optional callbacks
+
+    async def process_batch(self, data: List[ISocketRequest]) -> List[Any]:
+        """
+        Process a batch of compatible requests at once, the returned list should be
+        aligned with `data`.
+        > This is only used when `batch_size` is specified in `settings`.
+        > Progresses sent by `send_progress` will be sent to every request in the batch.
+        """
+
+        return [await self.process(d) for d in data]
+
+    def batch_key(self, data: ISocketRequest) -> Hashable:
+        """
+        Requests with the same `batch_key` are considered compatible, which means
+        they can be processed together by `process_batch`.
+        > By default, only requests with identical `extraData` are compatible.
+        """
+
+        return json.dumps(data.extraData, sort_keys=True)
+
     # internal APIs
 
     @property
@@ -34,14 +71,90 @@ class ISocketPlugin(IPlugin, metaclass=ABCMeta):
         ]
 
     async def __call__(self, data: ISocketRequest) -> None:
-        self.injections = {}
-        self.extra_responses = {}
-        middlewares = self.middlewares
-        for middleware in middlewares:
-            await middleware.before(data)
-        response = await self.process(data)
-        for middleware in middlewares:
-            response = await middleware(response)
+        responder = await self.execute(data)
+        if responder is not None:
+            await responder()
+
+    async def execute(self, data: ISocketRequest) -> Optional[Responder]:
+        """
+        Run the 'process' stage of the request, and return the 'respond' stage
+        (encoding, uploading, sending the final message, etc.) without running it.
+        > This makes it possible to start processing the next task while the current
+        one is still responding, see `Config.pipeline_buffer`.
+        > `None` will be returned if the task is cancelled.
+        """
+
+        middlewares = await self._before(data)
+        cached = self._get_cached_response()
+        if cached is not None:
+            return self._make_responder(middlewares, cached)
+        try:
+            response = await self.process(data)
+            self.elapsed_times.processed()
+        finally:
+            # pending progresses should not be sent after the final response
+            await self.progress_sender.close()
+        # nobody cares about the results of a cancelled task
+        if self.cancelled:
+            return None
+        return self._make_responder(middlewares, response)
+
+    async def execute_batch(  # type: ignore
+        self,
+        plugins: List["ISocketPlugin"],
+        data: List[ISocketRequest],
+    ) -> List[Optional[Responder]]:
+        """
+        The batched version of `execute`, the returned list is aligned with `data`.
+        > Exceptions occurred in `process_batch` will be raised directly.
+        """
+
+        all_middlewares = [await p._before(d) for p, d in zip(plugins, data)]
+        responses = [p._get_cached_response() for p in plugins]
+        indices = [i for i, response in enumerate(responses) if response is None]
+        self.batch_plugins = [plugins[i] for i in indices]
+        try:
+            if indices:
+                batch_responses = await self.process_batch([data[i] for i in indices])
+                for i in indices:
+                    plugins[i].elapsed_times.processed()
+            else:
+                batch_responses = []
+        finally:
+            self.batch_plugins = None
+            for plugin in plugins:
+                await plugin.progress_sender.close()
+        if len(batch_responses) != len(indices):
+            raise ValueError(
+                f"`process_batch` returned {len(batch_responses)} responses "
+                f"but {len(indices)} are expected"
+            )
+        for i, response in zip(indices, batch_responses):
+            responses[i] = response
+        responders: List[Optional[Responder]] = []
+        for plugin, middlewares, response in zip(plugins, all_middlewares, responses):
+            if plugin.cancelled:
+                responders.append(None)
+            else:
+                responders.append(plugin._make_responder(middlewares, response))
+        return responders
+
+    @property
+    def cancelled(self) -> bool:
+        """
+        Whether the task is cancelled (by the client, or because the client is
+        disconnected). Heavy plugins are encouraged to check this flag (or the return
+        value of `send_progress`) periodically and stop early.
+        > When processing a batch, this will be `True` only if all tasks in the batch
+        are cancelled.
+        """
+
+        if self.batch_plugins:
+            return all(plugin._cancelled for plugin in self.batch_plugins)
+        return self._cancelled
+
+    def cancel(self) -> None:
+        self._cancelled = True
 
     def to_react(self) -> Dict[str, Any]:
         return self.settings.to_react(
@@ -60,7 +173,10 @@ class ISocketPlugin(IPlugin, metaclass=ABCMeta):
         # if so, load it from the local file system directly
         if src.startswith("http://") and constants.UPLOAD_IMAGE_FOLDER_NAME in src:
             file = src.split(constants.UPLOAD_IMAGE_FOLDER_NAME)[1][1:]  # remove '/'
-            return server.get_image(file)
+            return await server.get_image(file)
+        # remote images will be fetched (and cached) by the `RemoteImageFetcher`
+        if is_remote_url(src):
+            return await get_remote_image(src)
         data = FetchImageModel(url=src, jpeg=False, return_image=True)
         return await ImageUploader.fetch_image(data)
 
@@ -71,16 +187,98 @@ class ISocketPlugin(IPlugin, metaclass=ABCMeta):
         textList: Optional[List[str]] = None,
         imageList: Optional[List[str]] = None,
     ) -> bool:
+        """
+        This method will not block, the message will be sent in `event_loop` later.
+        > If progresses are reported too frequently, only the latest one will be sent
+        (at most once every `Config.progress_interval` ms).
+        > Return `False` if the task is cancelled, or previous messages failed to be sent
+        (e.g., the client is disconnected), in which case the plugin should stop early.
+        """
+
         if textList is None and imageList is None:
             intermediate = None
         else:
             intermediate = ISocketIntermediate(textList=textList, imageList=imageList)
-        message = ISocketMessage.make_progress(self.task_hash, progress, intermediate)
-        return offload_run(self.send_message(message))
+        success = False
+        for plugin in self.batch_plugins or [self]:
+            if plugin.cancelled:
+                continue
+            hash = plugin.task_hash
+            message = ISocketMessage.make_progress(hash, progress, intermediate)
+            success = plugin.progress_sender.push(message) or success
+        return success
 
     def send_exception(self, message: str) -> bool:
-        message = ISocketMessage.make_exception(self.task_hash, message)
-        return offload_run(self.send_message(message))
+        """
+        This method will not block, the message will be sent in `event_loop` later
+        (after the in-flight progress, if any), and no more progresses will be sent.
+        > Return `False` if previous messages failed to be sent (e.g., the client is
+        disconnected).
+        """
+
+        exception = ISocketMessage.make_exception(self.task_hash, message)
+        return self.progress_sender.push_final(exception)
+
+    # internal methods
+
+    async def _before(self, data: ISocketRequest) -> List[IMiddleware]:
+        self.injections = {}
+        self.extra_responses = {}
+        self.progress_sender = ThrottledSender(
+            self.event_loop,
+            lambda message: self.send_message(message),
+            get_config().progress_interval / 1000,
+        )
+        self._fingerprint = None
+        self.from_cache = False
+        if self.settings.deterministic:
+            try:
+                self._fingerprint = get_request_fingerprint(data)
+            except Exception as err:
+                print_warning(f"failed to fingerprint request '{data.hash}' ({err})")
+        middlewares = self.middlewares
+        for middleware in middlewares:
+            await middleware.before(data)
+        return middlewares
+
+    async def _respond(self, middlewares: List[IMiddleware], response: Any) -> None:
+        for middleware in middlewares:
+            response = await middleware(response)
+        if (
+            self._fingerprint is not None
+            and isinstance(response, ISocketMessage)
+            and response.status == SocketStatus.FINISHED
+        ):
+            data = dict(final=response.data.final, injections=response.data.injections)
+            get_result_cache().put(self._fingerprint, json.dumps(data))
+
+    def _make_responder(
+        self, middlewares: List[IMiddleware], response: Any
+    ) -> Responder:
+        async def _responder() -> None:
+            await self._respond(middlewares, response)
+
+        return _responder
+
+    def _get_cached_response(self) -> Optional[ISocketMessage]:
+        """
+        Return the cached response of the current request (with `extra_responses`
+        and `injections` restored), if any.
+        > Responses returned here will skip the `process` and the upload steps.
+        """
+
+        if self._fingerprint is None:
+            return None
+        cached = get_result_cache().get(self._fingerprint)
+        if cached is None:
+            return None
+        data = json.loads(cached)
+        self.injections = data["injections"] or {}
+        self.from_cache = True
+        # `extra_responses` are already in the `final`, and cache hits should not
+        # refresh the ttl of the cached results
+        self._fingerprint = None
+        return ISocketMessage.make_success(self.task_hash, data["final"])
 
     def set_extra_response(self, key: str, value: Any) -> None:
         self.extra_responses[key] = value
@@ -1,7 +1,10 @@
 import time
 import asyncio
 
+from typing import Any
+from typing import Dict
 from typing import List
+from typing import Tuple
 from typing import Union
 from typing import Optional
 from PIL.Image import Image
@@ -39,18 +42,28 @@ class ResponseMiddleware(IMiddleware):
                     value=[dict(text=text, safe=True, reason="") for text in response],
                 )
             )
-        meta = PngInfo()
-        meta.add_text("request", self.request.json())
+        images: List[Image] = response  # type: ignore
         t = time.time()
-        audit = self.plugin.image_should_audit
-        upload = ImageUploader.upload_image
-        base_url = self.request.baseURL
-        user_json = self.request.get_user_json()
-        args = user_json, meta, base_url, False, audit
-        futures = [upload(im, *args) for im in response]
-        urls = [data.dict() for data in await asyncio.gather(*futures)]
+        results = await asyncio.gather(*[self._upload(im) for im in images])
         self.plugin.elapsed_times.upload = time.time() - t
-        return self.make_success(dict(type="image", value=urls))
+        self.plugin.elapsed_times.uploads = [elapsed for _, elapsed in results]
+        return self.make_success(dict(type="image", value=[r for r, _ in results]))
+
+    async def _upload(self, image: Image) -> Tuple[Dict[str, Any], float]:
+        t = time.time()
+        # `meta` will be modified by `upload_image`, so it should not be shared
+        meta = PngInfo()
+        meta.add_text("request", self.request.json())
+        data = await ImageUploader.upload_image(
+            image,
+            self.request.get_user_json(),
+            meta,
+            self.request.baseURL,
+            False,
+            self.plugin.image_should_audit,
+            self.plugin.settings.image_encoding,
+        )
+        return data.dict(), time.time() - t
 
 
 __all__ = [
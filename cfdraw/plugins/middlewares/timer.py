@@ -1,7 +1,12 @@
 from typing import List
+from typing import Union
 
+from cfdraw.utils.stats import get_condition
+from cfdraw.utils.stats import get_elapsed_stats
 from cfdraw.schema.plugins import PluginType
 from cfdraw.schema.plugins import IMiddleware
+from cfdraw.schema.plugins import Subscription
+from cfdraw.schema.plugins import ISocketRequest
 from cfdraw.plugins.middlewares.send_message import TResponse
 
 
@@ -11,14 +16,27 @@ class TimerMiddleware(IMiddleware):
         return True
 
     @property
-    def subscriptions(self) -> List[PluginType]:
-        return [PluginType.FIELDS]
+    def subscriptions(self) -> Union[List[PluginType], Subscription]:
+        return Subscription.ALL
+
+    async def before(self, request: ISocketRequest) -> None:
+        await super().before(request)
+        self.request = request
 
     async def process(self, response: TResponse) -> TResponse:
         if response is None:
             return None
-        self.plugin.elapsed_times.end()
-        response.data.elapsedTimes = self.plugin.elapsed_times
+        elapsed_times = self.plugin.elapsed_times
+        elapsed_times.end()
+        # feed the statistics, which will be used to estimate the ETA of the tasks
+        # (only the `process` stage occupies the workers, see `RequestQueue`)
+        duration = elapsed_times.process
+        if not self.plugin.from_cache and duration is not None:
+            eta_keys = self.plugin.settings.eta_keys
+            condition = get_condition(self.request.extraData, eta_keys)
+            get_elapsed_stats().record(self.plugin.identifier, condition, duration)
+        if self.plugin.type == PluginType.FIELDS:
+            response.data.elapsedTimes = elapsed_times
         return response
 
 
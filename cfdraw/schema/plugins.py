@@ -10,10 +10,13 @@ from typing import Dict
 from typing import List
 from typing import Type
 from typing import Union
+from typing import Literal
 from typing import TypeVar
 from typing import Callable
 from typing import Optional
+from typing import Hashable
 from typing import Coroutine
+from asyncio import AbstractEventLoop
 from aiohttp import ClientSession
 from pydantic import Field
 from pydantic import BaseModel
@@ -34,6 +37,8 @@ from cfdraw.parsers.chakra import TextAlign
 
 TPluginModel = TypeVar("TPluginModel")
 ISend = Callable[["ISocketMessage"], Coroutine[Any, Any, bool]]
+## the deferred 'respond' stage of a task, see `ISocketPlugin.execute`
+Responder = Callable[[], Coroutine[Any, Any, None]]
 
 
 class PluginType(str, Enum):
@@ -79,6 +84,28 @@ class ReactPluginType(str, Enum):
     BRUSH = "brush"
 
 
+class PluginLane(str, Enum):
+    """
+    * QUEUE: requests will be pushed to the (per-user) `RequestQueue`, where they
+    are scheduled fairly and their positions are broadcasted to the clients.
+    * FAST: requests will be executed directly by a separate, bounded executor,
+    useful for lightweight plugins or plugins that poll periodically.
+    """
+
+    QUEUE = "queue"
+    FAST = "fast"
+
+
+class ImageFormat(str, Enum):
+    PNG = "png"
+    WEBP = "webp"
+    JPEG = "jpeg"
+
+    @property
+    def suffix(self) -> str:
+        return "jpg" if self == ImageFormat.JPEG else self.value
+
+
 # general
 
 
@@ -86,6 +113,39 @@ def hash_identifier(hash: str, identifier: str) -> str:
     return f"{identifier}.{hash}"
 
 
+class ImageEncoding(BaseModel):
+    """
+    How the images returned by the plugins are encoded & stored.
+    > The metadata (`request`, `userJson`, etc.) is not embedded in the images, but
+    recorded in the `ReferenceIndex`, because identical images share the same file.
+    """
+
+    format: ImageFormat = Field(default=ImageFormat.PNG, description="Image format")
+    quality: int = Field(
+        default=90,
+        ge=1,
+        le=100,
+        description="Quality of the lossy formats (lossy WebP / JPEG)",
+    )
+    compress_level: int = Field(
+        default=6,
+        ge=0,
+        le=9,
+        description=(
+            "zlib compression level of PNG, lower is (much) faster but larger.\n"
+            "> `1` is a good choice for large images which are served locally."
+        ),
+    )
+    lossless: bool = Field(default=False, description="Whether to use lossless WebP")
+
+    def save_kwargs(self) -> Dict[str, Any]:
+        if self.format == ImageFormat.PNG:
+            return dict(format="PNG", compress_level=self.compress_level)
+        if self.format == ImageFormat.WEBP:
+            return dict(format="WEBP", quality=self.quality, lossless=self.lossless)
+        return dict(format="JPEG", quality=self.quality)
+
+
 class IPluginInfo(BaseModel):
     """
     This should align with the following interfaces locate at `cfdraw/.web/src/schema/_python.ts`:
@@ -111,6 +171,22 @@ class IPluginInfo(BaseModel):
     )
 
 
+# these fields are only used by the backend, so they will not be sent to the frontend
+INTERNAL_SETTINGS_FIELDS = {
+    "no_offload",
+    "concurrency",
+    "concurrency_group",
+    "batch_size",
+    "batch_window",
+    "lane",
+    "deterministic",
+    "eta_keys",
+    "cost",
+    "timeout",
+    "image_encoding",
+}
+
+
 class IPluginSettings(IChakra):
     """
     This should align with the `IPythonPlugin` locate at `cfdraw/.web/src/schema/_python.ts`,
@@ -281,6 +357,120 @@ Pivot of the plugin.
             "need to be executed in the main thread."
         ),
     )
+    concurrency: Optional[int] = Field(
+        None,
+        ge=1,
+        description=(
+            "Maximum number of tasks of this plugin that can be executed concurrently, "
+            "`None` means it is only limited by `Config.num_workers`.\n"
+            "> If `concurrency_group` is specified, the limit will be applied to "
+            "the whole group instead."
+        ),
+    )
+    concurrency_group: Optional[str] = Field(
+        None,
+        description=(
+            "Plugins with the same `concurrency_group` will share the same concurrency "
+            "limit, useful when they share the same (heavy) resource, e.g. a GPU model."
+        ),
+    )
+    batch_size: Optional[int] = Field(
+        None,
+        ge=1,
+        description=(
+            "If specified, up to `batch_size` compatible requests (see `batch_key` of "
+            "`ISocketPlugin`) of this plugin will be gathered from the queue and "
+            "processed together by `process_batch`."
+        ),
+    )
+    batch_window: int = Field(
+        50,
+        ge=0,
+        description=(
+            "Time (ms) to wait for compatible requests to arrive before processing "
+            "a batch, only take effect when `batch_size` is larger than 1."
+        ),
+    )
+    lane: Optional[PluginLane] = Field(
+        None,
+        description=(
+            "Which lane should the requests of this plugin go through, see `PluginLane` "
+            "for more details.\n"
+            "> If not specified, plugins with `updateInterval` will use the fast lane, "
+            "and others will use the queue."
+        ),
+    )
+
+    deterministic: bool = Field(
+        False,
+        description=(
+            "Whether the plugin always produces the same results for identical requests "
+            "(same `extraData`, same texts and same image contents). If so, the results "
+            "will be cached and reused (see `Config.result_cache_size`)."
+        ),
+    )
+
+    eta_keys: Optional[List[str]] = Field(
+        None,
+        description=(
+            "Keys of `extraData` that affect the execution time of the plugin (e.g., "
+            "number of steps, image size), the historical execution times will be "
+            "grouped by them to estimate the ETA of the pending tasks more accurately."
+        ),
+    )
+
+    cost: Optional[float] = Field(
+        None,
+        gt=0,
+        description=(
+            "Estimated cost (in seconds) of one task of this plugin, used by the "
+            "`weighted_fair` scheduler (see `Config.scheduler`).\n"
+            "> If not specified, the historical execution time will be used."
+        ),
+    )
+
+    timeout: Optional[float] = Field(
+        None,
+        gt=0,
+        description=(
+            "Maximum execution time (seconds) of a task (or a batch) of this plugin. "
+            "Tasks exceeding it will be abandoned with an `EXCEPTION` message, so the "
+            "worker can be freed.\n"
+            "> Threads cannot be killed, so the plugin will only be asked to cancel, "
+            "heavy plugins should check `cancelled` periodically to actually stop."
+        ),
+    )
+    image_encoding: Optional[ImageEncoding] = Field(
+        None,
+        description=(
+            "How the images returned by this plugin are encoded, "
+            "will use `Config.image_encoding` if not provided"
+        ),
+    )
+
+    @property
+    def resolved_lane(self) -> PluginLane:
+        if self.lane is not None:
+            return self.lane
+        if self.pluginInfo.updateInterval is not None:
+            return PluginLane.FAST
+        return PluginLane.QUEUE
+
+    @property
+    def consumes_images(self) -> bool:
+        """Whether the plugin is constrained to (some) image nodes."""
+
+        if self.nodeConstraint == NodeConstraints.IMAGE:
+            return True
+        rules = self.nodeConstraintRules
+        if rules is None:
+            return False
+        constraints = [
+            *(rules.some or []),
+            *(rules.every or []),
+            *(rules.exactly or []),
+        ]
+        return NodeConstraints.IMAGE in constraints
 
     def to_react(self, type: str, hash: str, identifier: str) -> Dict[str, Any]:
         def _pop_none(_d: Dict[str, Any]) -> None:
@@ -290,7 +480,7 @@ Pivot of the plugin.
                 elif isinstance(v, dict):
                     _pop_none(v)
 
-        d = self.dict(exclude={"pluginInfo"})
+        d = self.dict(exclude={"pluginInfo", *INTERNAL_SETTINGS_FIELDS})
         pI = self.pluginInfo
         kw = dict(exclude={"plugins"}) if isinstance(pI, IPluginGroupInfo) else {}
         plugin_info = self.pluginInfo.dict(**kw)
@@ -343,7 +533,12 @@ class ElapsedTimes(BaseModel):
     endTime: Optional[float]
     pending: Optional[float]
     executing: Optional[float]
+    ## time spent on the `process` stage, which excludes the responding stage (e.g.,
+    ## uploading, waiting for the pipeline), so it is used to estimate the ETA
+    process: Optional[float]
     upload: Optional[float]
+    ## time spent on uploading each image, aligned with the returned images
+    uploads: Optional[List[float]]
     total: Optional[float]
 
     def __init__(self, **data: Any):
@@ -356,6 +551,10 @@ class ElapsedTimes(BaseModel):
         if self.createTime is not None:
             self.pending = start - self.createTime
 
+    def processed(self) -> None:
+        if self.startTime is not None:
+            self.process = time.time() - self.startTime
+
     def end(self) -> None:
         end = time.time()
         self.endTime = end
@@ -367,6 +566,13 @@ class ElapsedTimes(BaseModel):
             self.total = end - self.createTime
 
 
+class EstimatedTimes(BaseModel):
+    """This should align with `IPythonEstimatedTimes` at `src/schema/_python.ts`"""
+
+    startTime: Optional[float] = Field(None, description="Estimated start time")
+    finishTime: Optional[float] = Field(None, description="Estimated finish time")
+
+
 # web
 
 
@@ -450,6 +656,13 @@ List of data extracted from `nodes`.
     )
     extraData: Dict[str, Any] = Field(..., description="Extra data of each plugin")
     isInternal: bool = Field(False, description="Whether the request is internal")
+    deadline: Optional[float] = Field(
+        None,
+        description=(
+            "Unix timestamp (seconds), if the request is still pending at this time, "
+            "it will be dropped without running"
+        ),
+    )
 
     def get_user_json(self) -> str:
         if self.userJson is not None:
@@ -457,6 +670,22 @@ List of data extracted from `nodes`.
         return json.dumps(dict(userId=self.userId))
 
 
+class ISocketCancelRequest(BaseModel):
+    """This should align with `IPythonSocketCancelRequest` at `src/schema/_python.ts`"""
+
+    type: Literal["cancel"] = Field(..., description="Type of the request")
+    hash: str = Field(..., description="The hash of the request to be cancelled")
+    userId: str = Field(..., description="The id of the user")
+
+
+class ISocketAttachRequest(BaseModel):
+    """This should align with `IPythonSocketAttachRequest` at `src/schema/_python.ts`"""
+
+    type: Literal["attach"] = Field(..., description="Type of the request")
+    hash: str = Field(..., description="The hash of the request to be re-attached")
+    userId: str = Field(..., description="The id of the user")
+
+
 class SocketStatus(str, Enum):
     """This should align with `PythonSocketStatus` at `src/schema/_python.ts`"""
 
@@ -465,6 +694,7 @@ class SocketStatus(str, Enum):
     FINISHED = "finished"
     EXCEPTION = "exception"
     INTERRUPTED = "interrupted"
+    REJECTED = "rejected"
 
 
 class ISocketIntermediate(BaseModel):
@@ -496,6 +726,10 @@ class ISocketResponse(BaseModel):
     final: Optional[Dict[str, Any]] = Field(None, description="Final response, if any")
     injections: Optional[Dict[str, Any]] = Field(None, description="Injections, if any")
     elapsedTimes: Optional[ElapsedTimes] = Field(None, description="Elapsed times.")
+    estimatedTimes: Optional[EstimatedTimes] = Field(
+        None,
+        description="Estimated times, only available in `PENDING` messages",
+    )
 
 
 class ISocketMessage(BaseModel):
@@ -545,6 +779,26 @@ class ISocketMessage(BaseModel):
             message=message,
         )
 
+    @classmethod
+    def make_interrupted(cls, hash: str, message: str) -> "ISocketMessage":
+        return cls(
+            hash=hash,
+            status=SocketStatus.INTERRUPTED,
+            total=0,
+            pending=0,
+            message=message,
+        )
+
+    @classmethod
+    def make_rejected(cls, hash: str, message: str) -> "ISocketMessage":
+        return cls(
+            hash=hash,
+            status=SocketStatus.REJECTED,
+            total=0,
+            pending=0,
+            message=message,
+        )
+
 
 # plugin interface
 
@@ -555,8 +809,12 @@ class IPlugin(ABC):
     http_session: ClientSession
     # task specific
     task_hash: str
+    ## the loop where the task is scheduled, messages should be sent in this loop
+    event_loop: AbstractEventLoop
     send_message: ISend
     elapsed_times: ElapsedTimes
+    ## whether the response of the task comes from the result cache
+    from_cache: bool = False
     extra_responses: Dict[str, Any]
     injections: Dict[str, Any]
     # internal
@@ -578,6 +836,31 @@ class IPlugin(ABC):
     async def __call__(self, data: ISocketRequest) -> None:
         pass
 
+    @abstractmethod
+    async def execute(self, data: ISocketRequest) -> Optional[Responder]:
+        pass
+
+    @abstractmethod
+    async def execute_batch(
+        self,
+        plugins: List["IPlugin"],
+        data: List[ISocketRequest],
+    ) -> List[Optional[Responder]]:
+        pass
+
+    @abstractmethod
+    def batch_key(self, data: ISocketRequest) -> Hashable:
+        pass
+
+    @property
+    @abstractmethod
+    def cancelled(self) -> bool:
+        pass
+
+    @abstractmethod
+    def cancel(self) -> None:
+        pass
+
     @abstractmethod
     def to_react(self) -> Dict[str, Any]:
         pass
@@ -738,15 +1021,21 @@ class IChatPluginInfo(IWorkflowPluginInfo):
 
 __all__ = [
     "ISend",
+    "Responder",
     "PluginType",
+    "PluginLane",
+    "ImageFormat",
     "ReactPluginType",
     # general
     "hash_identifier",
+    "ImageEncoding",
     "IPluginInfo",
     "IPluginSettings",
     # web
     "INodeData",
     "ISocketRequest",
+    "ISocketCancelRequest",
+    "ISocketAttachRequest",
     "SocketStatus",
     "ISocketIntermediate",
     "ISocketResponse",
@@ -1,11 +1,20 @@
+import time
+import threading
+
 from typing import Any
 from typing import Dict
+from typing import Tuple
 from typing import Generic
 from typing import TypeVar
+from typing import Hashable
+from typing import Callable
+from typing import Optional
 from typing import Protocol
+from collections import OrderedDict
 
 
 TResource = TypeVar("TResource", bound="Any", covariant=True)
+TValue = TypeVar("TValue")
 
 
 class IResourceFn(Generic[TResource], Protocol):
@@ -26,3 +35,90 @@ def cache_resource(fn: IResourceFn[TResource]) -> IResourceFn[TResource]:
             return self._cache[key]
 
     return Cache()
+
+
+class LRUCache(Generic[TValue]):
+    """
+    A thread-safe LRU cache.
+    > If `ttl` (seconds) is provided, entries will be expired `ttl` seconds after
+    they are put into the cache.
+    > If `max_bytes` is provided, the total size of the entries (measured by `sizeof`)
+    will be kept below it as well, entries larger than it will not be cached.
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        ttl: Optional[float] = None,
+        *,
+        max_bytes: Optional[int] = None,
+        sizeof: Optional[Callable[[TValue], int]] = None,
+    ) -> None:
+        if max_bytes is not None and sizeof is None:
+            raise ValueError("`sizeof` should be provided when `max_bytes` is provided")
+        self.capacity = capacity
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_bytes = 0
+        self._lock = threading.Lock()
+        self._cache: OrderedDict[Hashable, Tuple[float, TValue, int]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return dict(
+            size=len(self._cache),
+            capacity=self.capacity,
+            num_bytes=self.num_bytes,
+            max_bytes=self.max_bytes,
+            num_hits=self.num_hits,
+            num_misses=self.num_misses,
+        )
+
+    def get(self, key: Hashable) -> Optional[TValue]:
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                created, value, _ = cached
+                if self.ttl is None or time.time() - created <= self.ttl:
+                    self._cache.move_to_end(key)
+                    self.num_hits += 1
+                    return value
+                self._pop(key)
+            self.num_misses += 1
+            return None
+
+    def put(self, key: Hashable, value: TValue) -> None:
+        if self.capacity <= 0:
+            return
+        nbytes = 0 if self.sizeof is None else self.sizeof(value)
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            return
+        with self._lock:
+            self._pop(key)
+            self._cache[key] = time.time(), value, nbytes
+            self.num_bytes += nbytes
+            while len(self._cache) > self.capacity or (
+                self.max_bytes is not None and self.num_bytes > self.max_bytes
+            ):
+                _, (_, _, popped) = self._cache.popitem(last=False)
+                self.num_bytes -= popped
+
+    def remove(self, key: Hashable) -> None:
+        with self._lock:
+            self._pop(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+            self.num_bytes = 0
+
+    def _pop(self, key: Hashable) -> None:
+        cached = self._cache.pop(key, None)
+        if cached is not None:
+            self.num_bytes -= cached[2]
@@ -1,18 +1,52 @@
+import time
+import queue
+import functools
 import asyncio
 import logging
 import threading
 
 from typing import Any
+from typing import Dict
+from typing import List
+from typing import Generic
 from typing import TypeVar
+from typing import Optional
 from typing import Callable
 from typing import Coroutine
+from concurrent.futures import ThreadPoolExecutor
 from cftool.misc import get_err_msg
 from cftool.misc import print_error
 from cftool.misc import print_warning
-from concurrent.futures import ThreadPoolExecutor
+
+from cfdraw.config import get_config
+from cfdraw.utils.cache import cache_resource
 
 
 TFutureResponse = TypeVar("TFutureResponse")
+TResponse = TypeVar("TResponse")
+TMessage = TypeVar("TMessage")
+TLoopFinalizer = Callable[[], Coroutine[Any, Any, None]]
+
+loop_finalizers: List[TLoopFinalizer] = []
+
+
+def register_loop_finalizer(finalizer: TLoopFinalizer) -> TLoopFinalizer:
+    """
+    Register a `finalizer` which will be executed in every worker loop (e.g., the
+    loops of the `OffloadPool` workers) right before the loop is closed, so loop-bound
+    resources (e.g., `aiohttp` sessions) can be released in their own loops.
+    """
+
+    loop_finalizers.append(finalizer)
+    return finalizer
+
+
+def finalize_loop(loop: asyncio.AbstractEventLoop) -> None:
+    for finalizer in loop_finalizers:
+        try:
+            loop.run_until_complete(finalizer())
+        except Exception:
+            logging.exception(f"failed to execute loop finalizer '{finalizer}'")
 
 
 def deprecated(message: str) -> Callable[[type], type]:
@@ -31,16 +65,393 @@ def deprecated(message: str) -> Callable[[type], type]:
     return _deprecated
 
 
-# TODO : maybe there will be better solutions?
-async def offload(future: Coroutine[Any, Any, TFutureResponse]) -> TFutureResponse:
-    loop = asyncio.get_event_loop()
-    with ThreadPoolExecutor() as executor:
-        return await loop.run_in_executor(
-            executor,
-            lambda new_loop, _future: new_loop.run_until_complete(_future),
-            asyncio.new_event_loop(),
-            future,
+class OffloadJob:
+    def __init__(
+        self,
+        future: Coroutine[Any, Any, Any],
+        loop: asyncio.AbstractEventLoop,
+        result: "asyncio.Future[Any]",
+    ) -> None:
+        self.future = future
+        self.loop = loop
+        self.result = result
+        self.submit_time = time.time()
+        # will be set by the worker which executes the job
+        self.task: Optional["asyncio.Task[Any]"] = None
+        self.worker_loop: Optional[asyncio.AbstractEventLoop] = None
+        self.thread_id: Optional[int] = None
+        self.finished = False
+        self.abandoned = False
+
+    def resolve(self, result: Any) -> None:
+        self._callback(lambda: self.result.set_result(result))
+
+    def reject(self, err: BaseException) -> None:
+        self._callback(lambda: self.result.set_exception(err))
+
+    def _callback(self, fn: Callable[[], None]) -> None:
+        def _run() -> None:
+            if not self.result.done():
+                fn()
+
+        try:
+            self.loop.call_soon_threadsafe(_run)
+        except RuntimeError:
+            # the caller's loop is already closed, nobody cares about the result
+            pass
+
+
+class OffloadPool:
+    """
+    A pool of long-lived worker threads, each of them owns a reusable event loop.
+    * Coroutines submitted by `run` will be executed by the first idle worker, and
+    will wait in a shared queue if all workers are busy (i.e., the pool is saturated).
+    * Coroutines submitted from the workers themselves will be executed inline,
+    so nested `offload`s will not dead lock the pool.
+    * When the pool is shut down, coroutines which have not started yet are dropped
+    (their callers will get a `RuntimeError`).
+    * If the caller gives up a running coroutine (e.g., timeout), the coroutine will
+    be cancelled, and its worker will be replaced by a new one, so a hung coroutine
+    (e.g., a stuck HTTP call) will not occupy the pool forever. The stuck worker
+    will retire once the coroutine returns.
+    """
+
+    warn_interval = 60.0
+
+    def __init__(self, num_workers: int) -> None:
+        self.num_workers = max(1, num_workers)
+        self._jobs: "queue.SimpleQueue[Optional[OffloadJob]]" = queue.SimpleQueue()
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._closed = False
+        self._num_spawned = 0
+        # instrumentations
+        self._busy = 0
+        self._waiting = 0
+        self._max_waiting = 0
+        self._num_submitted = 0
+        self._num_saturated = 0
+        self._total_wait_time = 0.0
+        self._last_warned = 0.0
+        self._num_abandoned = 0
+        self._num_stuck = 0
+
+    @property
+    def in_worker(self) -> bool:
+        return getattr(self._local, "in_worker", False)
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(
+                num_workers=self.num_workers,
+                busy=self._busy,
+                waiting=self._waiting,
+                max_waiting=self._max_waiting,
+                num_submitted=self._num_submitted,
+                num_saturated=self._num_saturated,
+                total_wait_time=self._total_wait_time,
+                num_abandoned=self._num_abandoned,
+                num_stuck=self._num_stuck,
+            )
+
+    def start(self) -> None:
+        with self._lock:
+            if self._threads:
+                return
+            for _ in range(self.num_workers):
+                self._spawn()
+
+    def shutdown(self, timeout: Optional[float] = None) -> None:
+        """
+        Stop the workers, running coroutines will be waited for at most `timeout`
+        seconds (`None` means forever).
+        > This method blocks, so it should not be called in the event loop (e.g., use
+        `run_in_executor` instead), because the running coroutines may need the loop
+        (e.g., to send messages) to finish.
+        """
+
+        with self._lock:
+            threads = self._threads
+            self._threads = []
+            self._closed = True
+        while True:
+            try:
+                job = self._jobs.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                self._drop(job)
+        for _ in threads:
+            self._jobs.put(None)
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in threads:
+            thread.join(None if deadline is None else max(0.0, deadline - time.time()))
+        num_alive = sum(thread.is_alive() for thread in threads)
+        if num_alive > 0:
+            print_warning(
+                f"{num_alive} offload workers are still running after shutdown"
+            )
+        with self._lock:
+            self._closed = False
+
+    async def run(
+        self, future: Coroutine[Any, Any, TFutureResponse]
+    ) -> TFutureResponse:
+        if self.in_worker:
+            return await future
+        if self._closed:
+            future.close()
+            raise RuntimeError("offload pool is shut down")
+        self.start()
+        loop = asyncio.get_running_loop()
+        result = loop.create_future()
+        with self._lock:
+            self._num_submitted += 1
+            saturated = self._busy + self._waiting >= self.num_workers
+            self._waiting += 1
+            self._max_waiting = max(self._max_waiting, self._waiting)
+            if saturated:
+                self._num_saturated += 1
+            now = time.time()
+            should_warn = saturated and now - self._last_warned >= self.warn_interval
+            if should_warn:
+                self._last_warned = now
+        if should_warn:
+            print_warning(
+                f"offload pool is saturated ({self._waiting} tasks waiting), "
+                "consider increasing `offload_workers` in `Config`"
+            )
+        job = OffloadJob(future, loop, result)
+        self._jobs.put(job)
+        try:
+            return await result
+        except asyncio.CancelledError:
+            self._abandon(job)
+            raise
+
+    def _work(self) -> None:
+        self._local.in_worker = True
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            while True:
+                job = self._jobs.get()
+                if job is None:
+                    break
+                if self._closed:
+                    self._drop(job)
+                    continue
+                with self._lock:
+                    self._waiting -= 1
+                    self._total_wait_time += time.time() - job.submit_time
+                    # the caller has given up (e.g., timeout) before the job started
+                    abandoned = job.result.cancelled()
+                    if not abandoned:
+                        self._busy += 1
+                        job.task = loop.create_task(job.future)
+                        job.worker_loop = loop
+                        job.thread_id = threading.get_ident()
+                if abandoned:
+                    job.future.close()
+                    continue
+                try:
+                    job.resolve(loop.run_until_complete(job.task))  # type: ignore
+                except BaseException as err:
+                    job.reject(err)
+                finally:
+                    with self._lock:
+                        self._busy -= 1
+                        job.finished = True
+                        retire = job.abandoned
+                        if retire:
+                            self._num_stuck -= 1
+                # a replacement has already been started
+                if retire:
+                    break
+        finally:
+            finalize_loop(loop)
+            loop.close()
+
+    def _spawn(self) -> None:
+        # should be called with `_lock` held
+        thread = threading.Thread(
+            target=self._work,
+            name=f"cfdraw-offload-{self._num_spawned}",
+            daemon=True,
         )
+        self._num_spawned += 1
+        thread.start()
+        self._threads.append(thread)
+
+    def _abandon(self, job: OffloadJob) -> None:
+        with self._lock:
+            if job.task is None or job.finished or job.abandoned:
+                return
+            job.abandoned = True
+            self._num_abandoned += 1
+            self._num_stuck += 1
+            num_stuck = self._num_stuck
+            if self._threads and not self._closed:
+                self._threads = [t for t in self._threads if t.ident != job.thread_id]
+                self._spawn()
+        # this frees the worker at once if the coroutine is awaiting something, but
+        # blocking calls can only be waited
+        try:
+            job.worker_loop.call_soon_threadsafe(job.task.cancel)  # type: ignore
+        except RuntimeError:
+            pass
+        print_warning(
+            f"an offloaded coroutine is abandoned while running, its worker is replaced "
+            f"({num_stuck} workers are stuck in abandoned coroutines)"
+        )
+
+    def _drop(self, job: OffloadJob) -> None:
+        with self._lock:
+            self._waiting -= 1
+        job.future.close()
+        job.reject(RuntimeError("offload pool is shut down"))
+
+
+@cache_resource
+def get_offload_pool() -> OffloadPool:
+    return OffloadPool(get_config().num_offload_workers)
+
+
+async def offload(future: Coroutine[Any, Any, TFutureResponse]) -> TFutureResponse:
+    """Execute the `future` in the shared `OffloadPool`, so it will not block the current loop."""
+
+    return await get_offload_pool().run(future)
+
+
+@cache_resource
+def get_encode_pool() -> ThreadPoolExecutor:
+    num_workers = get_config().num_encode_workers
+    return ThreadPoolExecutor(num_workers, thread_name_prefix="cfdraw-encode")
+
+
+async def offload_encode(fn: Callable[..., TResponse], *args: Any) -> TResponse:
+    """
+    Execute the (synchronous) `fn` in the shared encoding pool.
+    > This is suitable for image encoding / decoding, because PIL releases the GIL
+    when doing the heavy lifting, so images can be processed in parallel.
+    > Unlike `offload`, this can be used inside the `OffloadPool` as well.
+    """
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_encode_pool(), functools.partial(fn, *args))
+
+
+class ThrottledSender(Generic[TMessage]):
+    """
+    Send messages in `loop` from any thread without blocking the caller.
+    * If a message is pushed before the previous one is sent, only the latest one
+    will be kept (i.e., messages are coalesced).
+    * Messages are sent at most once every `interval` seconds.
+    * A final message (e.g., an exception) can be sent by `push_final`, which will be
+    sent right after the in-flight one, and no more messages will be sent after it.
+    """
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        send: Callable[[TMessage], Coroutine[Any, Any, bool]],
+        interval: float,
+    ) -> None:
+        self.loop = loop
+        self.send = send
+        self.interval = interval
+        self.failed = False
+        self._lock = threading.Lock()
+        self._closed = False
+        self._latest: Optional[TMessage] = None
+        self._scheduled = False
+        self._last_sent: Optional[float] = None
+        self._sending: Optional["asyncio.Task[None]"] = None
+
+    def push(self, message: TMessage) -> bool:
+        """Return `False` if the sender is closed or any previous sending failed."""
+
+        with self._lock:
+            if self._closed:
+                return False
+            self._latest = message
+            if not self._scheduled:
+                self._scheduled = True
+                self.loop.call_soon_threadsafe(self._schedule)
+        return not self.failed
+
+    def push_final(self, message: TMessage) -> bool:
+        """
+        Drop the pending message (if any), send `message` right after the in-flight
+        one, and close the sender. Return `False` in the same cases as `push`.
+        """
+
+        with self._lock:
+            if self._closed:
+                return False
+            self._closed = True
+            self._latest = None
+        self.loop.call_soon_threadsafe(self._send_final, message)
+        return not self.failed
+
+    async def close(self) -> None:
+        """Drop the pending message (if any) and wait for the in-flight one to be sent."""
+
+        try:
+            running_loop: Optional[
+                asyncio.AbstractEventLoop
+            ] = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self.loop:
+            await self._drain()
+        else:
+            future = asyncio.run_coroutine_threadsafe(self._drain(), self.loop)
+            await asyncio.wrap_future(future)
+
+    def _schedule(self) -> None:
+        if self._last_sent is None:
+            delay = 0.0
+        else:
+            delay = max(0.0, self._last_sent + self.interval - self.loop.time())
+        self.loop.call_later(delay, self._flush)
+
+    def _flush(self) -> None:
+        with self._lock:
+            message = self._latest
+            self._latest = None
+            self._scheduled = False
+        if message is None:
+            return
+        self._last_sent = self.loop.time()
+        self._sending = self.loop.create_task(self._send(message))
+
+    def _send_final(self, message: TMessage) -> None:
+        previous = self._sending
+
+        async def _run() -> None:
+            if previous is not None:
+                await previous
+            await self._send(message)
+
+        self._sending = self.loop.create_task(_run())
+
+    async def _send(self, message: TMessage) -> None:
+        try:
+            if not await self.send(message):
+                self.failed = True
+        except Exception:
+            self.failed = True
+            logging.exception("[ThrottledSender] failed to send message")
+
+    async def _drain(self) -> None:
+        with self._lock:
+            self._closed = True
+            self._latest = None
+        if self._sending is not None:
+            await self._sending
 
 
 # TODO : maybe there will be better solutions?
@@ -58,6 +469,7 @@ def offload_run(future: Coroutine[Any, Any, bool]) -> bool:
             loop = asyncio.new_event_loop()
             asyncio.set_event_loop(loop)
             success = loop.run_until_complete(future)
+            finalize_loop(loop)
             loop.close()
             if success:
                 event.set()
@@ -0,0 +1,358 @@
+import re
+import json
+import time
+import socket
+import asyncio
+import hashlib
+import ipaddress
+
+from PIL import Image
+from yarl import URL
+from typing import Any
+from typing import Set
+from typing import Dict
+from typing import List
+from typing import Tuple
+from typing import Mapping
+from typing import Optional
+from aiohttp import ClientError
+from aiohttp import TCPConnector
+from aiohttp import ClientTimeout
+from aiohttp import ClientSession
+from aiohttp import ClientResponse
+from aiohttp import ThreadedResolver
+from aiohttp.abc import AbstractResolver
+from pathlib import Path
+from functools import partial
+from cftool.misc import print_warning
+from concurrent.futures import Future
+
+from cfdraw import constants
+from cfdraw.config import get_config
+from cfdraw.config import Config
+from cfdraw.utils.misc import offload_encode
+from cfdraw.utils.cache import cache_resource
+from cfdraw.utils.server import decode_image
+from cfdraw.utils.renditions import RenditionCache
+from cfdraw.schema.plugins import ISocketRequest
+
+
+# these failures are likely to be transient, so the requests will be retried
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+CHUNK_SIZE = 64 * 1024
+MAX_AGE_PATTERN = re.compile(r"max-age=(\d+)")
+
+
+def check_public_address(host: str, address: str) -> None:
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    if not ip.is_global:
+        raise ValueError(f"'{host}' resolves to a non-public address ({ip})")
+
+
+class PublicResolver(AbstractResolver):
+    """
+    Resolve the hosts with `ThreadedResolver`, and reject the ones which resolve to
+    non-public addresses.
+    > The checked addresses are exactly the ones to be connected, so the check cannot
+    be bypassed by resolving the host to another address afterwards (DNS rebinding).
+    """
+
+    def __init__(self) -> None:
+        self.resolver = ThreadedResolver()
+
+    async def resolve(
+        self,
+        host: str,
+        port: int = 0,
+        family: socket.AddressFamily = socket.AF_INET,
+    ) -> List[Any]:
+        infos = await self.resolver.resolve(host, port, family)
+        for info in infos:
+            check_public_address(host, info["host"])
+        return infos
+
+    async def close(self) -> None:
+        await self.resolver.close()
+
+
+class RemoteImageFetcher:
+    """
+    Fetch the remote images (e.g., images pasted from other sites).
+    * Requests are timed out (`Config.remote_fetch_timeout`), and retried with
+    exponential backoff on connection errors, timeouts, `429` and `5xx` responses.
+    * Responses are cached on disk (see `RenditionCache`), and stale ones will be
+    revalidated with their `ETag` / `Last-Modified`.
+    * Concurrent fetches of the same url are merged into one.
+    * The urls come from the clients, so only `http` / `https` urls are allowed, only
+    `image/*` responses within `Config.remote_max_size` are accepted, and hosts which
+    resolve to non-public addresses (loopback, private, link-local, etc.) are rejected
+    by the `PublicResolver` unless `Config.remote_allow_private_hosts` is enabled.
+    Redirects are followed manually, so every hop is checked as well.
+    > The fetcher owns a session which is bound to the main loop, so fetches issued in
+    other loops (e.g., in the `OffloadPool` workers) are executed there.
+    """
+
+    backoff = 0.5
+    max_redirects = 5
+
+    def __init__(self, config: Config) -> None:
+        folder = config.upload_remote_folder
+        self.cache = RenditionCache(folder, config.remote_cache_size)
+        self.timeout = config.remote_fetch_timeout
+        self.retries = config.remote_fetch_retries
+        self.min_ttl = config.remote_cache_min_ttl
+        self.prefetch_concurrency = config.remote_prefetch_concurrency
+        self.max_size = config.remote_max_size
+        self.allow_private_hosts = config.remote_allow_private_hosts
+        self.max_connections = config.http_max_connections
+        self.max_connections_per_host = config.http_max_connections_per_host
+        self.session: Optional[ClientSession] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._inflight: Dict[str, "asyncio.Future[bytes]"] = {}
+        self._prefetching: Set["Future[None]"] = set()
+        # instrumentations
+        self.num_fetched = 0
+        self.num_revalidated = 0
+        self.num_retries = 0
+        self.num_failed = 0
+        self.num_prefetched = 0
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return dict(
+            num_fetched=self.num_fetched,
+            num_revalidated=self.num_revalidated,
+            num_retries=self.num_retries,
+            num_failed=self.num_failed,
+            num_prefetched=self.num_prefetched,
+            cache=self.cache.stats,
+        )
+
+    def bind(self, loop: asyncio.AbstractEventLoop) -> None:
+        """This method should be called inside `loop`."""
+
+        resolver = None if self.allow_private_hosts else PublicResolver()
+        connector = TCPConnector(
+            limit=self.max_connections,
+            limit_per_host=self.max_connections_per_host,
+            resolver=resolver,
+        )
+        self.session = ClientSession(connector=connector)
+        self.loop = loop
+
+    async def unbind(self) -> None:
+        for future in list(self._prefetching):
+            future.cancel()
+        session = self.session
+        self.session = None
+        self.loop = None
+        if session is not None:
+            await session.close()
+
+    async def fetch(self, url: str) -> bytes:
+        """This method can be called in any loop."""
+
+        if self.loop is None:
+            raise RuntimeError("remote images can only be fetched when the app is up")
+        if asyncio.get_running_loop() is self.loop:
+            return await self._fetch(url)
+        future = asyncio.run_coroutine_threadsafe(self._fetch(url), self.loop)
+        return await asyncio.wrap_future(future)
+
+    def prefetch(self, urls: List[str]) -> None:
+        """
+        Fetch `urls` in the background (at most `prefetch_concurrency` of them at the
+        same time), so they are likely to be cached when they are actually loaded.
+        """
+
+        if not urls or self.loop is None:
+            return
+        prefetch = self._prefetch(list(dict.fromkeys(urls)))
+        future = asyncio.run_coroutine_threadsafe(prefetch, self.loop)
+        self._prefetching.add(future)
+        future.add_done_callback(self._prefetching.discard)
+
+    async def _prefetch(self, urls: List[str]) -> None:
+        semaphore = asyncio.Semaphore(self.prefetch_concurrency)
+
+        async def _run(url: str) -> None:
+            async with semaphore:
+                try:
+                    await self._fetch(url)
+                    self.num_prefetched += 1
+                except Exception as err:
+                    print_warning(f"failed to prefetch '{url}' ({err})")
+
+        await asyncio.gather(*map(_run, urls))
+
+    async def _fetch(self, url: str) -> bytes:
+        inflight = self._inflight.get(url)
+        if inflight is None:
+            inflight = asyncio.ensure_future(self._fetch_cached(url))
+            self._inflight[url] = inflight
+            inflight.add_done_callback(lambda _: self._inflight.pop(url, None))
+        # one cancelled caller should not cancel the others
+        return await asyncio.shield(inflight)
+
+    async def _fetch_cached(self, url: str) -> bytes:
+        name = hashlib.sha256(url.encode()).hexdigest()
+        meta_name = f"{name}.json"
+        body_path = self.cache.lookup(name)
+        meta_path = None if body_path is None else self.cache.lookup(meta_name)
+        meta: Dict[str, Any] = {}
+        if body_path is not None and meta_path is not None:
+            meta = json.loads(meta_path.read_text())
+            if meta["expires"] > time.time():
+                return await offload_encode(body_path.read_bytes)
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        status, data, res_headers = await self._request(url, headers)
+        if status == 304 and body_path is not None:
+            self.num_revalidated += 1
+            data = await offload_encode(body_path.read_bytes)
+        else:
+            self.num_fetched += 1
+            body_path = None
+        cache_control = res_headers.get("Cache-Control", "").lower()
+        if "no-store" in cache_control:
+            return data
+        if "no-cache" in cache_control:
+            ttl = 0
+        else:
+            match = MAX_AGE_PATTERN.search(cache_control)
+            ttl = max(self.min_ttl, int(match.group(1)) if match else 0)
+        meta = dict(
+            etag=res_headers.get("ETag", meta.get("etag")),
+            last_modified=res_headers.get("Last-Modified", meta.get("last_modified")),
+            expires=time.time() + ttl,
+        )
+        if body_path is None:
+            await offload_encode(self.cache.produce, name, partial(_write, data))
+        await offload_encode(self.cache.produce, meta_name, partial(_write_json, meta))
+        return data
+
+    async def _request(
+        self,
+        url: str,
+        headers: Dict[str, str],
+    ) -> Tuple[int, bytes, Mapping[str, str]]:
+        if self.session is None or self.loop is None:
+            raise RuntimeError("remote images can only be fetched when the app is up")
+        deadline = self.loop.time() + self.timeout
+        error: Exception = asyncio.TimeoutError(f"fetching '{url}' timed out")
+        for i in range(self.retries + 1):
+            if i > 0:
+                self.num_retries += 1
+                await asyncio.sleep(self.backoff * 2 ** (i - 1))
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                break
+            timeout = ClientTimeout(total=remaining)
+            try:
+                status, data, res_headers = await self._get(url, headers, timeout)
+                if status < 300 or status == 304:
+                    return status, data, res_headers
+                error = RuntimeError(f"failed to fetch '{url}' ({status})")
+                if status == 404:
+                    error = FileNotFoundError(f"'{url}' does not exist")
+                if status not in RETRY_STATUSES:
+                    break
+            except (ClientError, asyncio.TimeoutError) as err:
+                error = err
+            except ValueError as err:
+                error = err
+                break
+        self.num_failed += 1
+        raise error
+
+    async def _get(
+        self,
+        url: str,
+        headers: Dict[str, str],
+        timeout: ClientTimeout,
+    ) -> Tuple[int, bytes, Mapping[str, str]]:
+        if self.session is None:
+            raise RuntimeError("remote images can only be fetched when the app is up")
+        target = URL(url)
+        for _ in range(self.max_redirects + 1):
+            self._check_url(target)
+            async with self.session.get(
+                target,
+                headers=headers,
+                timeout=timeout,
+                allow_redirects=False,
+            ) as res:
+                location = res.headers.get("Location")
+                if res.status in REDIRECT_STATUSES and location is not None:
+                    target = target.join(URL(location))
+                    continue
+                if res.status >= 300:
+                    return res.status, b"", res.headers
+                return res.status, await self._read(url, res), res.headers
+        raise ValueError(f"too many redirects when fetching '{url}'")
+
+    async def _read(self, url: str, res: ClientResponse) -> bytes:
+        if not res.content_type.startswith("image/"):
+            raise ValueError(f"'{url}' is not an image ({res.content_type})")
+        too_large = ValueError(f"'{url}' exceeds {self.max_size} bytes")
+        if res.content_length is not None and res.content_length > self.max_size:
+            raise too_large
+        size = 0
+        chunks = []
+        # `Content-Length` may be absent or wrong, so the size is capped here as well
+        async for chunk in res.content.iter_chunked(CHUNK_SIZE):
+            size += len(chunk)
+            if size > self.max_size:
+                raise too_large
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    def _check_url(self, url: URL) -> None:
+        if url.scheme not in ("http", "https") or not url.host:
+            raise ValueError(f"'{url}' is not a valid remote url")
+        if self.allow_private_hosts:
+            return
+        # ip literals are connected directly, without going through the resolver
+        try:
+            ipaddress.ip_address(url.host)
+        except ValueError:
+            return
+        check_public_address(url.host, url.host)
+
+
+def _write(data: bytes, path: Path) -> None:
+    path.write_bytes(data)
+
+
+def _write_json(data: Dict[str, Any], path: Path) -> None:
+    path.write_text(json.dumps(data))
+
+
+@cache_resource
+def get_remote_fetcher() -> RemoteImageFetcher:
+    return RemoteImageFetcher(get_config())
+
+
+def is_remote_url(src: str) -> bool:
+    if not src.startswith(("http://", "https://")):
+        return False
+    return constants.UPLOAD_IMAGE_FOLDER_NAME not in src
+
+
+def get_remote_sources(request: ISocketRequest) -> List[str]:
+    """Return the remote sources of the (selected) image nodes of the `request`."""
+
+    nodes = [request.nodeData, *request.nodeDataList]
+    nodes = [node for node in nodes if node.type == "image" and node.src]
+    return [node.src for node in nodes if node.src and is_remote_url(node.src)]
+
+
+async def get_remote_image(url: str) -> Image.Image:
+    data = await get_remote_fetcher().fetch(url)
+    return await offload_encode(decode_image, data)
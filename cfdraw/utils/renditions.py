@@ -0,0 +1,102 @@
+import os
+import uuid
+import threading
+
+from typing import Any
+from typing import Dict
+from typing import Callable
+from typing import Optional
+from pathlib import Path
+from collections import OrderedDict
+
+from cfdraw.config import get_config
+from cfdraw.utils.cache import cache_resource
+
+
+class RenditionCache:
+    """
+    A size-bounded (LRU) disk cache of the renditions derived from the stored images
+    (e.g., their JPEG versions), so each of them is produced only once and can then
+    be served as a static file.
+    > The access order is persisted as the modification time of the files, so the
+    cache survives restarts.
+    """
+
+    def __init__(self, folder: Path, max_size: int) -> None:
+        self.folder = folder
+        self.max_size = max_size
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evicted = 0
+        self._lock = threading.Lock()
+        self._sizes: OrderedDict[str, int] = OrderedDict()
+        self._total = 0
+        # unfinished renditions (see `_get`) are hidden files
+        files = [p for p in folder.iterdir() if not p.name.startswith(".")]
+        for path in sorted(files, key=lambda p: p.stat().st_mtime):
+            size = path.stat().st_size
+            self._sizes[path.name] = size
+            self._total += size
+        with self._lock:
+            self._evict()
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return dict(
+            num_files=len(self._sizes),
+            total_size=self._total,
+            max_size=self.max_size,
+            num_hits=self.num_hits,
+            num_misses=self.num_misses,
+            num_evicted=self.num_evicted,
+        )
+
+    def lookup(self, name: str) -> Optional[Path]:
+        """Return the path of the rendition named `name` if it is cached."""
+
+        path = self.folder / name
+        with self._lock:
+            hit = name in self._sizes and path.is_file()
+            if not hit:
+                self.num_misses += 1
+                return None
+            self._sizes.move_to_end(name)
+            self.num_hits += 1
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+
+    def produce(self, name: str, produce: Callable[[Path], None]) -> Path:
+        """Produce the rendition named `name` with `produce`, and cache it."""
+
+        path = self.folder / name
+        # produce to a temporary file first, so concurrent readers will never see
+        # a partially written rendition
+        tmp_path = self.folder / f".{uuid.uuid4().hex}.{name}"
+        try:
+            produce(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        size = path.stat().st_size
+        with self._lock:
+            self._total += size - self._sizes.pop(name, 0)
+            self._sizes[name] = size
+            self._evict()
+        return path
+
+    def _evict(self) -> None:
+        # the latest rendition is always kept, since it is about to be used
+        while self._total > self.max_size and len(self._sizes) > 1:
+            name, size = self._sizes.popitem(last=False)
+            self._total -= size
+            self.num_evicted += 1
+            (self.folder / name).unlink(missing_ok=True)
+
+
+@cache_resource
+def get_rendition_cache() -> RenditionCache:
+    config = get_config()
+    return RenditionCache(config.upload_rendition_folder, config.rendition_cache_size)
@@ -1,94 +1,664 @@
-import random
+import json
+import time
+import zlib
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import threading
 
 import numpy as np
 
 from io import BytesIO
 from PIL import Image
+from functools import partial
 from typing import Any
+from typing import Set
 from typing import Dict
+from typing import List
+from typing import Tuple
 from typing import Union
+from typing import Mapping
+from typing import Callable
+from typing import Iterator
+from typing import Optional
+from typing import NamedTuple
+from typing import AsyncIterator
+from concurrent.futures import Future
+from pathlib import Path
 from fastapi import Response
+from email.utils import formatdate
 from PIL.PngImagePlugin import PngInfo
+from fastapi.responses import FileResponse
+from fastapi.responses import StreamingResponse
 from cftool.cv import to_rgb
 from cftool.cv import np_to_bytes
 from cftool.web import raise_err
-from cftool.misc import random_hash
 
+from cfdraw import constants
 from cfdraw.config import get_config
+from cfdraw.utils.cache import LRUCache
+from cfdraw.utils.misc import offload_encode
+from cfdraw.utils.misc import get_encode_pool
+from cfdraw.utils.cache import cache_resource
+from cfdraw.utils.storage import get_image_storage
+from cfdraw.utils.renditions import get_rendition_cache
+from cfdraw.schema.plugins import INodeData
+from cfdraw.schema.plugins import ImageFormat
+from cfdraw.schema.plugins import ImageEncoding
+from cfdraw.schema.plugins import ISocketRequest
 
 
-def save_svg(svg: str, base_url: str) -> Dict[str, Any]:
-    config = get_config()
-    state = random.getstate()
-    random.seed()
-    path = config.upload_image_folder / f"{random_hash()}.svg"
-    random.setstate(state)
-    with path.open("w") as f:
-        f.write(svg)
-    base_url = base_url.rstrip("/")
-    url = f"{base_url}/{path.relative_to(config.upload_root_path).as_posix()}"
-    return dict(w=0, h=0, url=url)
+# metadata of WebP / JPEG images will be stored in this EXIF tag
+# stored files are never modified, so they can be cached 'forever'
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+MEDIA_TYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".webp": "image/webp",
+    ".svg": "image/svg+xml",
+}
+
+
+async def save_svg(svg: str, base_url: str) -> Dict[str, Any]:
+    content = svg.encode()
+    digest = hashlib.sha256(content).hexdigest()
+    storage = get_image_storage()
+    name = await storage.put(digest, "svg", lambda: content, MEDIA_TYPES[".svg"])
+    return dict(w=0, h=0, url=_get_image_url(base_url, name))
 
 
-def save_image(image: Image.Image, meta: PngInfo, base_url: str) -> Dict[str, Any]:
+async def save_image(
+    image: Image.Image,
+    meta: PngInfo,
+    base_url: str,
+    encoding: Optional[ImageEncoding] = None,
+) -> Dict[str, Any]:
+    """
+    Save the `image` with the given `encoding` (will use `Config.image_encoding` if
+    not provided).
+    > Images are content-addressed (see `ImageStorage`), so if an identical image
+    (same pixels & `encoding`) was saved before, it will be reused. Since the files
+    are shared, the text chunks of `meta` (e.g., `userJson`, `request`) are not
+    embedded in them, but recorded for each reference in the `ReferenceIndex`.
+    > Digesting & encoding are executed in the encoding pool (see `offload_encode`).
+    > If `Config.defer_image_persistence` is enabled, new images will be encoded &
+    persisted in the background, see `HotImages` for more details.
+    """
+
     w, h = image.size
-    config = get_config()
-    state = random.getstate()
-    random.seed()
-    path = config.upload_image_folder / f"{random_hash()}.png"
-    random.setstate(state)
-    image.save(path, pnginfo=meta)
+    if encoding is None:
+        encoding = get_config().image_encoding
+    suffix = encoding.format.suffix
+    texts = get_png_texts(meta)
+    digest = await offload_encode(get_image_content_digest, image, encoding)
+    encode = partial(encode_image, image, encoding)
+    media_type = MEDIA_TYPES[f".{suffix}"]
+    name = f"{digest}.{suffix}"
+    lossless = _is_lossless(image, encoding)
+    storage = get_image_storage()
+    hot_images = get_hot_images()
+    if hot_images.loop is None or await storage.stat(name) is not None:
+        name = await storage.put(digest, suffix, encode, media_type, texts)
+        # the next plugin is likely to load this image, so there is no need to decode
+        if lossless:
+            get_decoded_image_cache().put((name, False), image)
+    else:
+        hot_images.defer(name, image, lossless, encode, media_type, texts)
+    return dict(w=w, h=h, url=_get_image_url(base_url, name))
+
+
+def _is_lossless(image: Image.Image, encoding: ImageEncoding) -> bool:
+    """whether decoding the encoded `image` will get the exact `image` back"""
+
+    if encoding.format != ImageFormat.PNG:
+        return False
+    return image.mode in ("1", "L", "LA", "P", "RGB", "RGBA")
+
+
+def get_image_content_digest(image: Image.Image, encoding: ImageEncoding) -> str:
+    """
+    The digest is computed from the pixels (rather than the encoded bytes), so
+    duplicates can be detected before encoding.
+    """
+
+    sha = hashlib.sha256()
+    sha.update(f"{image.mode}|{image.size}|{encoding.json()}".encode())
+    sha.update(image.tobytes())
+    return sha.hexdigest()
+
+
+def _get_image_url(base_url: str, name: str) -> str:
     base_url = base_url.rstrip("/")
-    url = f"{base_url}/{path.relative_to(config.upload_root_path).as_posix()}"
-    return dict(w=w, h=h, url=url)
+    return f"{base_url}/{constants.UPLOAD_IMAGE_FOLDER_NAME}/{name}"
 
 
-def get_svg_response(file: str) -> Response:
-    config = get_config()
+def encode_image(image: Image.Image, encoding: ImageEncoding) -> bytes:
+    image, kwargs = _prepare_image(image, encoding)
+    with BytesIO() as f:
+        image.save(f, **kwargs)
+        return f.getvalue()
+
+
+def _prepare_image(
+    image: Image.Image,
+    encoding: ImageEncoding,
+) -> Tuple[Image.Image, Dict[str, Any]]:
+    kwargs = encoding.save_kwargs()
+    if encoding.format == ImageFormat.PNG:
+        return image, kwargs
+    if encoding.format == ImageFormat.JPEG:
+        if image.mode not in ("RGB", "L", "CMYK"):
+            image = to_rgb(image)
+    elif image.mode not in ("RGB", "RGBA"):
+        has_alpha = "A" in image.mode or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "RGB")
+    return image, kwargs
+
+
+def get_png_texts(meta: PngInfo) -> Dict[str, str]:
+    """Extract the text chunks (`tEXt`, `zTXt` & `iTXt`) of `meta`."""
+
+    texts = {}
+    for chunk in meta.chunks:
+        cid, data = chunk[0], chunk[1]
+        if cid not in (b"tEXt", b"zTXt", b"iTXt"):
+            continue
+        key, rest = data.split(b"\0", 1)
+        if cid == b"tEXt":
+            value = rest.decode("latin-1")
+        elif cid == b"zTXt":
+            value = zlib.decompress(rest[1:]).decode("latin-1")
+        else:
+            compressed, rest = rest[0], rest[2:]
+            _, _, text = rest.split(b"\0", 2)
+            value = (zlib.decompress(text) if compressed else text).decode("utf-8")
+        texts[key.decode("latin-1")] = value
+    return texts
+
+
+class HotImage(NamedTuple):
+    image: Image.Image
+    lossless: bool
+    encoded: "Future[bytes]"
+
+
+class HotImages:
+    """
+    Freshly generated images whose persistence is deferred (see
+    `Config.defer_image_persistence`), so their urls can be returned immediately.
+    * The images are kept (decoded) in memory, and will be served from here until
+    they are persisted.
+    * Encoding starts in the encoding pool right away, while the persistence is
+    scheduled in `loop` (the main loop), because the loops of the `OffloadPool`
+    workers only run when they are executing something.
+    > Lossless images will be moved to the decoded image cache after persisted.
+    """
+
+    def __init__(self) -> None:
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+        self._images: Dict[str, HotImage] = {}
+        # name -> metadata of the references, duplicates may be saved before persisted
+        self._refs: Dict[str, List[Optional[Dict[str, str]]]] = {}
+        self._persisting: Set["Future[None]"] = set()
+        # instrumentations
+        self.num_deferred = 0
+        self.num_hits = 0
+        self.num_persisted = 0
+        self.num_failed = 0
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._images
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return dict(
+            size=len(self._images),
+            num_deferred=self.num_deferred,
+            num_hits=self.num_hits,
+            num_persisted=self.num_persisted,
+            num_failed=self.num_failed,
+        )
+
+    def bind(self, loop: asyncio.AbstractEventLoop) -> None:
+        """persistence can only be deferred after a (main) loop is bound"""
+
+        self.loop = loop
+
+    def defer(
+        self,
+        name: str,
+        image: Image.Image,
+        lossless: bool,
+        encode: Callable[[], bytes],
+        content_type: Optional[str],
+        meta: Optional[Dict[str, str]] = None,
+    ) -> None:
+        if self.loop is None:
+            raise ValueError("`loop` should be bound before deferring persistence")
+        with self._lock:
+            if name in self._images:
+                self._refs[name].append(meta)
+                return
+            encoded = get_encode_pool().submit(encode)
+            self._images[name] = HotImage(image, lossless, encoded)
+            self._refs[name] = [meta]
+            self.num_deferred += 1
+            persist = self._persist(name, content_type)
+            future = asyncio.run_coroutine_threadsafe(persist, self.loop)
+            self._persisting.add(future)
+        future.add_done_callback(self._discard)
+
+    async def get_image(self, name: str) -> Optional[Image.Image]:
+        """return a copy of the hot image, or `None` if it is not hot (any more)"""
+
+        hot = self._get(name)
+        if hot is None:
+            return None
+        if hot.lossless:
+            return hot.image.copy()
+        # lossy images should look the same as they will be after persisted
+        data = await asyncio.shield(asyncio.wrap_future(hot.encoded))
+        return await offload_encode(decode_image, data)
+
+    async def get_bytes(self, name: str) -> Optional[bytes]:
+        """return the encoded hot image, or `None` if it is not hot (any more)"""
+
+        hot = self._get(name)
+        if hot is None:
+            return None
+        return await asyncio.shield(asyncio.wrap_future(hot.encoded))
+
+    async def flush(self) -> None:
+        """wait until all hot images are persisted"""
+
+        with self._lock:
+            futures = list(self._persisting)
+        if futures:
+            await asyncio.gather(*map(asyncio.wrap_future, futures))
+
+    def _get(self, name: str) -> Optional[HotImage]:
+        with self._lock:
+            hot = self._images.get(name)
+            if hot is not None:
+                self.num_hits += 1
+            return hot
+
+    def _discard(self, future: "Future[None]") -> None:
+        with self._lock:
+            self._persisting.discard(future)
+
+    async def _persist(self, name: str, content_type: Optional[str]) -> None:
+        hot = self._images[name]
+        storage = get_image_storage()
+        digest, suffix = name.split(".", 1)
+        try:
+            data = await asyncio.wrap_future(hot.encoded)
+            with self._lock:
+                meta = self._refs[name][0]
+            await storage.put(digest, suffix, lambda: data, content_type, meta)
+            # the image is no longer hot after this, so no more references will come
+            with self._lock:
+                self._images.pop(name, None)
+                metas = self._refs.pop(name, [])
+            for meta in metas[1:]:
+                storage.index.add_ref(name, len(data), meta)
+            if hot.lossless:
+                get_decoded_image_cache().put((name, False), hot.image)
+            self.num_persisted += 1
+        except Exception:
+            self.num_failed += 1
+            logging.exception(f"failed to persist '{name}'")
+        finally:
+            with self._lock:
+                self._images.pop(name, None)
+                self._refs.pop(name, None)
+
+
+@cache_resource
+def get_hot_images() -> HotImages:
+    return HotImages()
+
+
+async def read_image(file: str) -> bytes:
+    """read the stored `file`, hot images (see `HotImages`) will be read from memory"""
+
+    data = await get_hot_images().get_bytes(file)
+    if data is not None:
+        return data
+    return await get_image_storage().get(file)
+
+
+async def get_svg_response(file: str) -> Response:
     try:
-        svg_path = config.upload_image_folder / file
-        with svg_path.open("r") as f:
-            content = f.read()
+        content = await get_image_storage().get(file)
         return Response(content=content, media_type="image/svg+xml")
     except Exception as err:
         raise_err(err)
 
 
-def get_image(file: str, jpeg: bool = False) -> Image.Image:
-    config = get_config()
-    try:
-        image = Image.open(config.upload_image_folder / file)
-        if not jpeg:
-            return image
-        with BytesIO() as f:
-            to_rgb(image).save(f, format="JPEG", quality=95)
-            f.seek(0)
-            image = Image.open(f)
-            image.load()
+async def get_jpeg_rendition(file: str, quality: int = 95) -> Path:
+    """Return the local path of the (cached) JPEG rendition of the stored `file`."""
+
+    cache = get_rendition_cache()
+    name = f"{file.split('.', 1)[0]}.q{quality}.jpg"
+    path = cache.lookup(name)
+    if path is None:
+        data = await read_image(file)
+        produce = partial(_save_jpeg, data, quality)
+        path = await offload_encode(cache.produce, name, produce)
+    return path
+
+
+def _save_jpeg(data: bytes, quality: int, path: Path) -> None:
+    with Image.open(BytesIO(data)) as image:
+        to_rgb(image).save(path, format="JPEG", quality=quality)
+
+
+@cache_resource
+def get_decoded_image_cache() -> LRUCache[Image.Image]:
+    max_bytes = get_config().decoded_image_cache_size
+    return LRUCache(4096, max_bytes=max_bytes, sizeof=get_image_nbytes)
+
+
+def get_image_nbytes(image: Image.Image) -> int:
+    bytes_per_band = {"I": 4, "F": 4, "I;16": 2}.get(image.mode, 1)
+    return image.width * image.height * len(image.getbands()) * bytes_per_band
+
+
+def decode_image(source: Union[Path, bytes]) -> Image.Image:
+    image = Image.open(source if isinstance(source, Path) else BytesIO(source))
+    image.load()
+    return image
+
+
+async def get_image(file: str, jpeg: bool = False) -> Image.Image:
+    """
+    Return the decoded stored `file`.
+    > Decoded images are cached (see `Config.decoded_image_cache_size`), and a copy
+    will be returned every time, so callers can modify it freely.
+    """
+
+    key = file, jpeg
+    cache = get_decoded_image_cache()
+    image = cache.get(key)
+    if image is not None:
+        return image.copy()
+    if not jpeg:
+        image = await get_hot_images().get_image(file)
+        if image is not None:
             return image
+    try:
+        source: Union[Path, bytes]
+        if jpeg:
+            source = await get_jpeg_rendition(file)
+        else:
+            storage = get_image_storage()
+            local_path = storage.local_path(file)
+            source = await storage.get(file) if local_path is None else local_path
+        decoded = await offload_encode(decode_image, source)
+        cache.put(key, decoded)
+        return decoded.copy()
     except Exception as err:
         raise_err(err)
 
 
-def get_image_response(  # type: ignore
+async def get_image_response(  # type: ignore
     file: str,
     jpeg: bool = False,
     return_image: bool = False,
 ) -> Union[Response, Image.Image]:
-    config = get_config()
+    if return_image:
+        return await get_image(file, jpeg)
     try:
-        image = Image.open(config.upload_image_folder / file)
-        if not jpeg:
-            if return_image:
-                return image
-            content = np_to_bytes(np.array(image))
-        else:
-            with BytesIO() as f:
-                to_rgb(image).save(f, format="JPEG", quality=95)
-                f.seek(0)
-                if return_image:
-                    return Image.open(f)
-                content = f.read()
+        if jpeg:
+            path = await get_jpeg_rendition(file)
+            content = await offload_encode(path.read_bytes)
+            return Response(content=content, media_type="image/jpeg")
+        content = await read_image(file)
+        if not file.endswith(".png"):
+            content = await offload_encode(_to_png_bytes, content)
         return Response(content=content, media_type="image/png")
     except Exception as err:
         raise_err(err)
+
+
+def _to_png_bytes(content: bytes) -> bytes:
+    with Image.open(BytesIO(content)) as image:
+        return np_to_bytes(np.array(image))
+
+
+async def get_stored_file_response(file: str, headers: Mapping[str, str]) -> Response:
+    """
+    Serve the stored `file` directly, see `get_file_response` for more details.
+    > Files stored in the local file system are served as 'zero-copy' file responses,
+    while the others are streamed from the storage backend.
+    > Hot images (see `HotImages`) are served from memory.
+    """
+
+    data = await get_hot_images().get_bytes(file)
+    if data is not None:
+        return _get_bytes_response(file, data, headers)
+    storage = get_image_storage()
+    path = storage.local_path(file)
+    if path is not None:
+        return get_file_response(path, headers)
+    try:
+        stat = await storage.stat(file)
+        if stat is None:
+            raise FileNotFoundError(f"'{file}' does not exist")
+        size, mtime = stat.size, stat.mtime
+    except Exception as err:
+        raise_err(err)
+
+    def _full(common_headers: Dict[str, str]) -> Response:
+        return StreamingResponse(
+            storage.stream(file),
+            headers={**common_headers, "Content-Length": str(size)},
+            media_type=_get_media_type(file),
+        )
+
+    stream = partial(storage.stream, file)
+    return _make_file_response(file, size, mtime, headers, stream, _full)
+
+
+def _get_bytes_response(
+    name: str,
+    data: bytes,
+    headers: Mapping[str, str],
+) -> Response:
+    def _full(common_headers: Dict[str, str]) -> Response:
+        media_type = _get_media_type(name)
+        return Response(content=data, headers=common_headers, media_type=media_type)
+
+    def _stream(start: int, end: int) -> Iterator[bytes]:
+        yield data[start : end + 1]
+
+    return _make_file_response(name, len(data), time.time(), headers, _stream, _full)
+
+
+def get_file_response(path: Path, headers: Mapping[str, str]) -> Response:
+    """
+    Serve the (immutable) file at `path` directly (without decoding / re-encoding),
+    with:
+    * a strong `ETag` derived from the file name, which identifies the content since
+    stored files are never modified.
+    * `Cache-Control: immutable`, and `304` responses to the conditional requests.
+    * single-range `Range` requests (multi-range requests will get the full file).
+    """
+
+    try:
+        stat = path.stat()
+        if not path.is_file():
+            raise FileNotFoundError(f"'{path.name}' is not a file")
+    except Exception as err:
+        raise_err(err)
+
+    def _full(common_headers: Dict[str, str]) -> Response:
+        return FileResponse(
+            path,
+            headers=common_headers,
+            media_type=_get_media_type(path.name),
+            stat_result=stat,
+        )
+
+    stream = partial(_iter_file, path)
+    return _make_file_response(
+        path.name, stat.st_size, stat.st_mtime, headers, stream, _full
+    )
+
+
+def _get_media_type(name: str) -> Optional[str]:
+    return MEDIA_TYPES.get(Path(name).suffix) or mimetypes.guess_type(name)[0]
+
+
+def _make_file_response(
+    name: str,
+    size: int,
+    mtime: float,
+    headers: Mapping[str, str],
+    stream: Callable[[int, int], Union[Iterator[bytes], AsyncIterator[bytes]]],
+    full: Callable[[Dict[str, str]], Response],
+) -> Response:
+    etag = f'"{Path(name).stem}"'
+    common_headers = {
+        "ETag": etag,
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL,
+        "Last-Modified": formatdate(mtime, usegmt=True),
+        "Accept-Ranges": "bytes",
+    }
+    if _match_etag(headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=common_headers)
+    range_header = headers.get("range")
+    if_range = headers.get("if-range")
+    if range_header is not None and (if_range is None or if_range == etag):
+        try:
+            byte_range = _parse_range(range_header, size)
+        except ValueError:
+            return Response(
+                status_code=416, headers={"Content-Range": f"bytes */{size}"}
+            )
+        if byte_range is not None:
+            start, end = byte_range
+            range_headers = {
+                **common_headers,
+                "Content-Range": f"bytes {start}-{end}/{size}",
+                "Content-Length": str(end - start + 1),
+            }
+            return StreamingResponse(
+                stream(start, end),
+                status_code=206,
+                headers=range_headers,
+                media_type=_get_media_type(name),
+            )
+    return full(common_headers)
+
+
+def _match_etag(if_none_match: Optional[str], etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # weak comparison is used for `If-None-Match`
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def _parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Return the (inclusive) byte range specified by `header`, or `None` if it should
+    be ignored (malformed or multi-range). Raise `ValueError` if it is unsatisfiable.
+    """
+
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep or not (first + last).isdigit():
+        return None
+    if not first:
+        suffix = int(last)
+        if suffix == 0 or size == 0:
+            raise ValueError("empty suffix range")
+        return max(0, size - suffix), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if end < start:
+        return None
+    if start >= size:
+        raise ValueError("range starts after the end of the file")
+    return start, min(end, size - 1)
+
+
+def _iter_file(path: Path, start: int, end: int) -> Iterator[bytes]:
+    chunk_size = 64 * 1024
+    with path.open("rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def get_local_file(src: str) -> Optional[str]:
+    """Return the file name if `src` refers to a local (uploaded) image."""
+
+    if src.startswith("http://") and constants.UPLOAD_IMAGE_FOLDER_NAME in src:
+        return src.split(constants.UPLOAD_IMAGE_FOLDER_NAME)[1][1:]  # remove '/'
+    return None
+
+
+# fingerprints
+
+
+@cache_resource
+def get_result_cache() -> LRUCache[str]:
+    config = get_config()
+    return LRUCache(config.result_cache_size, config.result_cache_ttl)
+
+
+def get_image_digest(src: str) -> str:
+    """
+    Return the digest of the image referred by `src`.
+    > Stored images are content-addressed and never modified, so their names are
+    sufficient to identify their contents.
+    > For remote images, the url itself will be used since the content is unknown.
+    """
+
+    return hashlib.sha256((get_local_file(src) or src).encode()).hexdigest()
+
+
+def get_request_fingerprint(request: ISocketRequest) -> str:
+    """
+    Return the fingerprint of `request`, identical requests (i.e., same plugin, same
+    `extraData`, same texts and same image contents) will have identical fingerprints.
+    > Other attributes of the nodes (e.g., positions) are not taken into account.
+    """
+
+    def _node(node: INodeData) -> Dict[str, Any]:
+        src = node.src
+        return dict(
+            type=node.type,
+            text=node.text,
+            src=None if not src else get_image_digest(src),
+            children=None if node.children is None else list(map(_node, node.children)),
+        )
+
+    data = dict(
+        identifier=request.identifier,
+        baseURL=request.baseURL,
+        extraData=request.extraData,
+        nodeData=_node(request.nodeData),
+        nodeDataList=list(map(_node, request.nodeDataList)),
+    )
+    data_str = json.dumps(data, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(data_str.encode()).hexdigest()
@@ -0,0 +1,113 @@
+import json
+import threading
+
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Tuple
+from typing import Optional
+from collections import deque
+
+from cfdraw.utils.cache import cache_resource
+
+
+class RollingStats:
+    """Keep the latest `window` samples, and compute the statistics on them."""
+
+    def __init__(self, window: int) -> None:
+        self._lock = threading.Lock()
+        self._samples: deque = deque(maxlen=window)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def add(self, value: float) -> None:
+        with self._lock:
+            self._samples.append(value)
+
+    def quantile(self, q: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        position = (len(samples) - 1) * q
+        lower = int(position)
+        upper = min(lower + 1, len(samples) - 1)
+        ratio = position - lower
+        return samples[lower] * (1.0 - ratio) + samples[upper] * ratio
+
+
+class ElapsedStats:
+    """
+    Rolling statistics of the execution time (the `process` stage) of each plugin.
+    > If `condition` is provided (see `get_condition`), statistics will also be
+    collected for each condition, and will be preferred when there are at least
+    `min_samples` samples.
+    """
+
+    def __init__(self, window: int = 100, min_samples: int = 3) -> None:
+        self.window = window
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._stats: Dict[Tuple[str, Optional[str]], RollingStats] = {}
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {
+            f"{identifier}[{condition}]"
+            if condition
+            else identifier: dict(
+                num_samples=len(stats),
+                p50=stats.quantile(0.5),
+                p90=stats.quantile(0.9),
+            )
+            for (identifier, condition), stats in list(self._stats.items())
+        }
+
+    def record(
+        self, identifier: str, condition: Optional[str], duration: float
+    ) -> None:
+        self._get(identifier, None).add(duration)
+        if condition is not None:
+            self._get(identifier, condition).add(duration)
+
+    def estimate(
+        self,
+        identifier: str,
+        condition: Optional[str] = None,
+        q: float = 0.5,
+    ) -> Optional[float]:
+        """return the `q` quantile of the execution time, `None` if no samples"""
+
+        if condition is not None:
+            stats = self._stats.get((identifier, condition))
+            if stats is not None and len(stats) >= self.min_samples:
+                return stats.quantile(q)
+        stats = self._stats.get((identifier, None))
+        if stats is None:
+            return None
+        return stats.quantile(q)
+
+    def _get(self, identifier: str, condition: Optional[str]) -> RollingStats:
+        key = identifier, condition
+        stats = self._stats.get(key)
+        if stats is None:
+            with self._lock:
+                stats = self._stats.setdefault(key, RollingStats(self.window))
+        return stats
+
+
+def get_condition(
+    extra_data: Dict[str, Any], keys: Optional[List[str]]
+) -> Optional[str]:
+    """extract the values of `keys` from `extra_data` as the condition of the stats"""
+
+    if not keys:
+        return None
+    values = {key: extra_data.get(key) for key in keys}
+    return json.dumps(values, sort_keys=True, default=str)
+
+
+@cache_resource
+def get_elapsed_stats() -> ElapsedStats:
+    return ElapsedStats()
@@ -0,0 +1,567 @@
+import os
+import re
+import json
+import hmac
+import time
+import uuid
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import datetime
+import threading
+
+from abc import abstractmethod
+from abc import ABC
+from yarl import URL
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Type
+from typing import Tuple
+from typing import Callable
+from typing import Optional
+from typing import NamedTuple
+from typing import AsyncIterator
+from aiohttp import ClientTimeout
+from aiohttp import TCPConnector
+from aiohttp import ClientSession
+from aiohttp import ClientResponse
+from pathlib import Path
+from functools import partial
+from email.utils import parsedate_to_datetime
+from urllib.parse import quote
+from urllib.parse import urlsplit
+from urllib.parse import parse_qsl
+from cftool.misc import print_warning
+from concurrent.futures import ThreadPoolExecutor
+
+from cfdraw.config import Config
+from cfdraw.config import get_config
+from cfdraw.utils.misc import offload_encode
+from cfdraw.utils.misc import register_loop_finalizer
+from cfdraw.utils.cache import cache_resource
+
+
+CHUNK_SIZE = 64 * 1024
+DIGEST_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+
+class BlobStat(NamedTuple):
+    size: int
+    mtime: float
+    etag: Optional[str] = None
+
+
+class IBlobStorage(ABC):
+    """
+    The backend where the stored files (the uploaded / generated images) live.
+    > `key`s are '/' separated relative paths, e.g., `ab/cd/abcd...png`.
+    """
+
+    @abstractmethod
+    def __init__(self, config: Config) -> None:
+        pass
+
+    @abstractmethod
+    async def put(self, key: str, data: bytes, content_type: Optional[str]) -> None:
+        pass
+
+    @abstractmethod
+    async def get(self, key: str) -> bytes:
+        """Raise `FileNotFoundError` if `key` does not exist."""
+
+    @abstractmethod
+    async def stat(self, key: str) -> Optional[BlobStat]:
+        """Return `None` if `key` does not exist."""
+
+    @abstractmethod
+    async def delete(self, key: str) -> None:
+        pass
+
+    @abstractmethod
+    def stream(
+        self,
+        key: str,
+        start: int = 0,
+        end: Optional[int] = None,
+    ) -> AsyncIterator[bytes]:
+        """Stream the (inclusive) byte range [`start`, `end`] of `key`."""
+
+    # optional callbacks
+
+    def local_path(self, key: str) -> Optional[Path]:
+        """
+        Return the local path of `key` if the backend is backed by the local file
+        system, which enables the 'zero-copy' file responses.
+        """
+
+        return None
+
+    async def close(self) -> None:
+        pass
+
+
+TBlobStorage = Type[IBlobStorage]
+storage_backends: Dict[str, TBlobStorage] = {}
+
+
+def register_storage_backend(name: str) -> Callable[[TBlobStorage], TBlobStorage]:
+    def _register(backend_type: TBlobStorage) -> TBlobStorage:
+        if name in storage_backends:
+            raise ValueError(f"storage backend '{name}' already exists")
+        storage_backends[name] = backend_type
+        return backend_type
+
+    return _register
+
+
+def make_blob_storage(config: Config) -> IBlobStorage:
+    backend_type = storage_backends.get(config.storage_backend)
+    if backend_type is None:
+        raise ValueError(
+            f"unrecognized storage backend '{config.storage_backend}' occurred, "
+            f"available backends are: {', '.join(storage_backends)}"
+        )
+    return backend_type(config)
+
+
+async def _run_sync(fn: Callable[..., Any], *args: Any) -> Any:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, partial(fn, *args))
+
+
+@register_storage_backend("local")
+class LocalBlobStorage(IBlobStorage):
+    """Store the files under `Config.upload_image_folder`."""
+
+    def __init__(self, config: Config) -> None:
+        self.root = config.upload_image_folder
+
+    def local_path(self, key: str) -> Path:
+        return self.root / key
+
+    async def put(self, key: str, data: bytes, content_type: Optional[str]) -> None:
+        await _run_sync(self._put, key, data)
+
+    async def get(self, key: str) -> bytes:
+        return await _run_sync(self.local_path(key).read_bytes)
+
+    async def stat(self, key: str) -> Optional[BlobStat]:
+        path = self.local_path(key)
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return None
+        if not path.is_file():
+            return None
+        return BlobStat(stat.st_size, stat.st_mtime)
+
+    async def delete(self, key: str) -> None:
+        self.local_path(key).unlink(missing_ok=True)
+
+    async def stream(
+        self,
+        key: str,
+        start: int = 0,
+        end: Optional[int] = None,
+    ) -> AsyncIterator[bytes]:
+        with self.local_path(key).open("rb") as f:
+            f.seek(start)
+            remaining = None if end is None else end - start + 1
+            while remaining is None or remaining > 0:
+                size = CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)
+                chunk = await _run_sync(f.read, size)
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def _put(self, key: str, data: bytes) -> None:
+        path = self.local_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first, so readers never see partial files
+        tmp_path = path.with_name(f".{uuid.uuid4().hex}.{path.name}")
+        try:
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+
+def sign_v4(
+    method: str,
+    url: str,
+    headers: Dict[str, str],
+    payload_hash: str,
+    access_key: str,
+    secret_key: str,
+    region: str,
+    service: str = "s3",
+    now: Optional[datetime.datetime] = None,
+) -> Dict[str, str]:
+    """
+    Sign the request with AWS Signature Version 4, return the signed headers.
+    > `url` should be already percent-encoded.
+    """
+
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+    amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+    date = now.strftime("%Y%m%d")
+    parsed = urlsplit(url)
+    signed_headers = {k.lower(): v.strip() for k, v in headers.items()}
+    signed_headers["host"] = parsed.netloc
+    signed_headers["x-amz-date"] = amz_date
+    signed_headers["x-amz-content-sha256"] = payload_hash
+    names = sorted(signed_headers)
+    query = sorted(
+        (quote(k, safe="-_.~"), quote(v, safe="-_.~"))
+        for k, v in parse_qsl(parsed.query, keep_blank_values=True)
+    )
+    canonical_request = "\n".join(
+        [
+            method,
+            parsed.path or "/",
+            "&".join(f"{k}={v}" for k, v in query),
+            "".join(f"{name}:{signed_headers[name]}\n" for name in names),
+            ";".join(names),
+            payload_hash,
+        ]
+    )
+    scope = f"{date}/{region}/{service}/aws4_request"
+    string_to_sign = "\n".join(
+        [
+            "AWS4-HMAC-SHA256",
+            amz_date,
+            scope,
+            hashlib.sha256(canonical_request.encode()).hexdigest(),
+        ]
+    )
+    key = f"AWS4{secret_key}".encode()
+    for msg in (date, region, service, "aws4_request"):
+        key = hmac.new(key, msg.encode(), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+    signed_headers["authorization"] = (
+        f"AWS4-HMAC-SHA256 Credential={access_key}/{scope}, "
+        f"SignedHeaders={';'.join(names)}, Signature={signature}"
+    )
+    return signed_headers
+
+
+@register_storage_backend("s3")
+class S3BlobStorage(IBlobStorage):
+    """
+    Store the files in an S3-compatible object storage (AWS S3, MinIO, etc.), so
+    multiple backend replicas can share them.
+    > Path-style urls (`{endpoint}/{bucket}/{key}`) are used.
+    > Connections are pooled & reused, one session per event loop (sessions cannot
+    be shared across loops, and the plugins are executed in the `OffloadPool`).
+    > Each session is closed in its own loop: the sessions of the worker loops are
+    closed when the workers stop (see `register_loop_finalizer`), and the session of
+    the main loop is closed by `close`.
+    """
+
+    def __init__(self, config: Config) -> None:
+        if not config.s3_endpoint or not config.s3_bucket:
+            raise ValueError(
+                "`s3_endpoint` and `s3_bucket` should be provided "
+                "when `storage_backend` is 's3'"
+            )
+        self.endpoint = config.s3_endpoint.rstrip("/")
+        self.bucket = config.s3_bucket
+        self.prefix = config.s3_prefix
+        self.region = config.s3_region
+        self.access_key = config.s3_access_key or ""
+        self.secret_key = config.s3_secret_key or ""
+        self.max_connections = config.s3_max_connections
+        self.timeout = config.s3_timeout
+        self._lock = threading.Lock()
+        self._sessions: Dict[asyncio.AbstractEventLoop, ClientSession] = {}
+        register_loop_finalizer(self.close)
+
+    async def put(self, key: str, data: bytes, content_type: Optional[str]) -> None:
+        headers = {} if content_type is None else {"Content-Type": content_type}
+        async with await self._request("PUT", key, data, headers) as res:
+            await self._check(res, key)
+
+    async def get(self, key: str) -> bytes:
+        async with await self._request("GET", key) as res:
+            await self._check(res, key)
+            return await res.read()
+
+    async def stat(self, key: str) -> Optional[BlobStat]:
+        async with await self._request("HEAD", key) as res:
+            if res.status == 404:
+                return None
+            await self._check(res, key)
+            last_modified = res.headers.get("Last-Modified")
+            if last_modified is None:
+                mtime = time.time()
+            else:
+                mtime = parsedate_to_datetime(last_modified).timestamp()
+            size = int(res.headers.get("Content-Length", 0))
+            return BlobStat(size, mtime, res.headers.get("ETag"))
+
+    async def delete(self, key: str) -> None:
+        async with await self._request("DELETE", key) as res:
+            if res.status != 404:
+                await self._check(res, key)
+
+    async def stream(
+        self,
+        key: str,
+        start: int = 0,
+        end: Optional[int] = None,
+    ) -> AsyncIterator[bytes]:
+        headers = {}
+        if start > 0 or end is not None:
+            headers["Range"] = f"bytes={start}-{'' if end is None else end}"
+        async with await self._request("GET", key, headers=headers) as res:
+            await self._check(res, key)
+            async for chunk in res.content.iter_chunked(CHUNK_SIZE):
+                yield chunk
+
+    async def close(self) -> None:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            session = self._sessions.pop(loop, None)
+        if session is not None:
+            await session.close()
+
+    def _get_session(self) -> ClientSession:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            session = self._sessions.get(loop)
+            if session is None or session.closed:
+                session = ClientSession(
+                    connector=TCPConnector(limit=self.max_connections),
+                    timeout=ClientTimeout(
+                        sock_connect=self.timeout,
+                        sock_read=self.timeout,
+                    ),
+                )
+                self._sessions[loop] = session
+        return session
+
+    async def _request(
+        self,
+        method: str,
+        key: str,
+        data: bytes = b"",
+        headers: Optional[Dict[str, str]] = None,
+    ) -> ClientResponse:
+        url = f"{self.endpoint}/{self.bucket}/{quote(self.prefix + key)}"
+        payload_hash = hashlib.sha256(data).hexdigest()
+        signed = sign_v4(
+            method,
+            url,
+            headers or {},
+            payload_hash,
+            self.access_key,
+            self.secret_key,
+            self.region,
+        )
+        return await self._get_session().request(
+            method,
+            URL(url, encoded=True),
+            data=data or None,
+            headers=signed,
+        )
+
+    async def _check(self, res: ClientResponse, key: str) -> None:
+        if res.status == 404:
+            raise FileNotFoundError(f"'{key}' does not exist")
+        if res.status >= 300:
+            detail = await res.text()
+            raise RuntimeError(f"s3 request on '{key}' failed ({res.status}): {detail}")
+
+
+class ReferenceIndex:
+    """
+    A simple sqlite based index of the stored files, which records how many times
+    each of them is referenced (i.e., saved).
+    * The metadata (e.g., `userJson`, `request`) of each reference is recorded here
+    as well, rather than embedded in the (shared) files.
+    * Writes are executed in a dedicated thread, so they will not block the event
+    loop. Reads are executed there as well, so they will see the previous writes.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self._lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix="cfdraw-index")
+        # files are saved in different threads
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "create table if not exists files ("
+            "name text PRIMARY KEY, size integer, refs integer, "
+            "create_time real, update_time real)"
+        )
+        self._conn.execute(
+            "create table if not exists refs (name text, meta text, create_time real)"
+        )
+        self._conn.execute("create index if not exists refs_name on refs (name)")
+        self._conn.commit()
+
+    async def get_stats(self) -> Dict[str, Any]:
+        sql = "SELECT COUNT(*), SUM(refs), SUM(size) FROM files"
+        rows = await self._fetch(sql, [])
+        num_files, num_refs, total_size = rows[0] if rows else (0, 0, 0)
+        return dict(
+            num_files=num_files,
+            num_refs=num_refs or 0,
+            total_size=total_size or 0,
+        )
+
+    def add_ref(
+        self,
+        name: str,
+        size: int,
+        meta: Optional[Dict[str, str]] = None,
+    ) -> None:
+        now = time.time()
+        statements = [
+            (
+                "INSERT INTO files VALUES (?, ?, 1, ?, ?) ON CONFLICT(name) "
+                "DO UPDATE SET refs=refs+1, update_time=excluded.update_time",
+                [name, size, now, now],
+            )
+        ]
+        if meta:
+            sql = "INSERT INTO refs VALUES (?, ?, ?)"
+            statements.append((sql, [name, json.dumps(meta), now]))
+        self._execute(statements)
+
+    async def get_refs(self, name: str) -> int:
+        rows = await self._fetch("SELECT refs FROM files WHERE name=?", [name])
+        return rows[0][0] if rows else 0
+
+    async def get_meta(self, name: str) -> List[Dict[str, str]]:
+        """return the metadata of the references of `name`, in the order they are saved"""
+
+        sql = "SELECT meta FROM refs WHERE name=? ORDER BY create_time"
+        rows = await self._fetch(sql, [name])
+        return [json.loads(meta) for meta, in rows]
+
+    def close(self) -> None:
+        """
+        Wait for the pending writes and close the index, later writes are ignored.
+        > This method blocks, so it should not be called in the event loop.
+        """
+
+        self._writer.shutdown()
+        with self._lock:
+            self._conn.close()
+
+    def _execute(self, statements: List[Tuple[str, List[Any]]]) -> None:
+        try:
+            self._writer.submit(self._write, statements)
+        except RuntimeError:
+            print_warning("reference index is closed, the references are ignored")
+
+    def _write(self, statements: List[Tuple[str, List[Any]]]) -> None:
+        # indexing is best-effort, it should never break the uploads
+        try:
+            with self._lock:
+                for sql, params in statements:
+                    self._conn.execute(sql, params)
+                self._conn.commit()
+        except Exception:
+            logging.exception(f"failed to execute '{statements}'")
+
+    async def _fetch(self, sql: str, params: List[Any]) -> List[Any]:
+        # reads are queued behind the pending writes, so they are awaited off the loop
+        future = self._writer.submit(self._read, sql, params)
+        return await asyncio.wrap_future(future)
+
+    def _read(self, sql: str, params: List[Any]) -> List[Any]:
+        try:
+            with self._lock:
+                return self._conn.execute(sql, params).fetchall()
+        except Exception:
+            logging.exception(f"failed to execute '{sql}'")
+            return []
+
+
+class ImageStorage:
+    """
+    A content-addressed storage of the uploaded / generated images, on top of an
+    `IBlobStorage` backend.
+    * Files are named by the digests of their contents, so identical images are
+    only stored (and encoded) once, later saves will only add references to them.
+    * Files are sharded into nested sub-folders (e.g., `ab/cd/abcd...png`) to keep
+    each folder small, while their names (and therefore urls) remain flat.
+    * Files saved before the content-addressing (with random names, directly under
+    the root) are still resolvable.
+    """
+
+    def __init__(self, backend: IBlobStorage, index: ReferenceIndex, depth: int = 2):
+        self.backend = backend
+        self.index = index
+        self.depth = depth
+
+    def get_key(self, name: str) -> str:
+        stem = name.split(".", 1)[0]
+        # fallback to the legacy flat layout
+        if not DIGEST_PATTERN.fullmatch(stem):
+            return name
+        shards = [name[2 * i : 2 * i + 2] for i in range(self.depth)]
+        return "/".join(shards + [name])
+
+    def local_path(self, name: str) -> Optional[Path]:
+        return self.backend.local_path(self.get_key(name))
+
+    async def put(
+        self,
+        digest: str,
+        suffix: str,
+        encode: Callable[[], bytes],
+        content_type: Optional[str] = None,
+        meta: Optional[Dict[str, str]] = None,
+    ) -> str:
+        """
+        Store a file whose content digest is `digest`, and return its name.
+        > `encode` will only be called (in the encoding pool) if the file does not
+        exist yet.
+        > `meta` belongs to this reference only, so it is recorded in the index (see
+        `ReferenceIndex`) instead of the file.
+        """
+
+        name = f"{digest}.{suffix}"
+        key = self.get_key(name)
+        stat = await self.backend.stat(key)
+        if stat is not None:
+            size = stat.size
+        else:
+            data = await offload_encode(encode)
+            await self.backend.put(key, data, content_type)
+            size = len(data)
+        self.index.add_ref(name, size, meta)
+        return name
+
+    async def get(self, name: str) -> bytes:
+        return await self.backend.get(self.get_key(name))
+
+    async def stat(self, name: str) -> Optional[BlobStat]:
+        return await self.backend.stat(self.get_key(name))
+
+    def stream(
+        self,
+        name: str,
+        start: int = 0,
+        end: Optional[int] = None,
+    ) -> AsyncIterator[bytes]:
+        return self.backend.stream(self.get_key(name), start, end)
+
+    async def close(self) -> None:
+        await self.backend.close()
+        await asyncio.get_running_loop().run_in_executor(None, self.index.close)
+
+
+@cache_resource
+def get_image_storage() -> ImageStorage:
+    config = get_config()
+    index = ReferenceIndex(config.upload_root_path / "images.sqlite")
+    return ImageStorage(make_blob_storage(config), index)
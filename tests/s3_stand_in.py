@@ -0,0 +1,137 @@
+"""
+A minimal, in-memory stand-in of an S3-compatible object storage, which verifies
+the SigV4 signatures of the requests. It is only meant to test `S3BlobStorage`.
+"""
+
+import re
+import time
+import hashlib
+import datetime
+
+from aiohttp import web
+from typing import Dict
+from typing import Tuple
+from typing import Callable
+from typing import Optional
+from typing import Awaitable
+from email.utils import formatdate
+
+from cfdraw.utils.storage import sign_v4
+
+
+AUTH_PATTERN = re.compile(
+    r"AWS4-HMAC-SHA256 Credential=([^/]+)/\d{8}/([^/]+)/s3/aws4_request, "
+    r"SignedHeaders=([^,]+), Signature=[0-9a-f]{64}"
+)
+RANGE_PATTERN = re.compile(r"bytes=(\d+)-(\d*)")
+Handler = Callable[[web.Request], Awaitable[web.StreamResponse]]
+
+
+class S3Object:
+    def __init__(self, data: bytes, content_type: Optional[str]) -> None:
+        self.data = data
+        self.content_type = content_type or "application/octet-stream"
+        self.mtime = time.time()
+        self.etag = f'"{hashlib.md5(data).hexdigest()}"'
+
+
+class S3StandIn:
+    def __init__(self, access_key: str, secret_key: str, region: str) -> None:
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.objects: Dict[Tuple[str, str], S3Object] = {}
+        self.num_requests = 0
+        self.num_rejected = 0
+        self.runner: Optional[web.AppRunner] = None
+        self.endpoint = ""
+
+    async def start(self) -> str:
+        app = web.Application(middlewares=[self._verify])
+        app.router.add_route("*", "/{bucket}/{key:.+}", self._handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]  # type: ignore
+        self.endpoint = f"http://127.0.0.1:{port}"
+        return self.endpoint
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    @web.middleware
+    async def _verify(
+        self, request: web.Request, handler: Handler
+    ) -> web.StreamResponse:
+        self.num_requests += 1
+        body = await request.read()
+        error = self._check_signature(request, body)
+        if error is not None:
+            self.num_rejected += 1
+            return web.Response(status=403, text=error)
+        return await handler(request)
+
+    def _check_signature(self, request: web.Request, body: bytes) -> Optional[str]:
+        authorization = request.headers.get("Authorization", "")
+        match = AUTH_PATTERN.fullmatch(authorization)
+        if match is None:
+            return "missing or malformed authorization"
+        access_key, region, names = match.groups()
+        if access_key != self.access_key or region != self.region:
+            return "unknown credential"
+        payload_hash = request.headers.get("x-amz-content-sha256", "")
+        if payload_hash != hashlib.sha256(body).hexdigest():
+            return "payload hash mismatch"
+        amz_date = request.headers.get("x-amz-date", "")
+        now = datetime.datetime.strptime(amz_date, "%Y%m%dT%H%M%SZ")
+        now = now.replace(tzinfo=datetime.timezone.utc)
+        auto_signed = {"host", "x-amz-date", "x-amz-content-sha256"}
+        headers = {
+            name: request.headers[name]
+            for name in names.split(";")
+            if name not in auto_signed and name in request.headers
+        }
+        expected = sign_v4(
+            request.method,
+            f"http://{request.host}{request.raw_path}",
+            headers,
+            payload_hash,
+            self.access_key,
+            self.secret_key,
+            self.region,
+            now=now,
+        )
+        if expected["authorization"] != authorization:
+            return "signature mismatch"
+        return None
+
+    async def _handle(self, request: web.Request) -> web.StreamResponse:
+        key = request.match_info["bucket"], request.match_info["key"]
+        if request.method == "PUT":
+            data = await request.read()
+            self.objects[key] = S3Object(data, request.content_type)
+            return web.Response(headers={"ETag": self.objects[key].etag})
+        if request.method == "DELETE":
+            self.objects.pop(key, None)
+            return web.Response(status=204)
+        obj = self.objects.get(key)
+        if obj is None:
+            return web.Response(status=404, text="NoSuchKey")
+        headers = {
+            "ETag": obj.etag,
+            "Content-Type": obj.content_type,
+            "Last-Modified": formatdate(obj.mtime, usegmt=True),
+        }
+        if request.method not in ("GET", "HEAD"):
+            return web.Response(status=405)
+        match = RANGE_PATTERN.fullmatch(request.headers.get("Range", ""))
+        if match is None:
+            return web.Response(body=obj.data, headers=headers)
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else len(obj.data) - 1
+        end = min(end, len(obj.data) - 1)
+        headers["Content-Range"] = f"bytes {start}-{end}/{len(obj.data)}"
+        return web.Response(status=206, body=obj.data[start : end + 1], headers=headers)
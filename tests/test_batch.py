@@ -0,0 +1,45 @@
+import time
+
+from cfdraw import *
+from typing import Any
+from typing import List
+
+
+class BatchPlugin(IFieldsPlugin):
+    notification = """
+Requests of this plugin will be gathered and processed in batches (up to 4 requests).
+Try submitting from multiple tabs at the same time to see the batch size grow!
+"""
+
+    @property
+    def settings(self) -> IPluginSettings:
+        return IPluginSettings(
+            w=300,
+            h=180,
+            tooltip="Reverse the text, in batches",
+            pivot=PivotType.CENTER,
+            batch_size=4,
+            batch_window=500,
+            pluginInfo=IFieldsPluginInfo(
+                definitions=dict(text=ITextField(default="Hello, world!")),
+            ),
+        )
+
+    # requests with different texts can be processed in the same batch
+    def batch_key(self, data: ISocketRequest) -> Any:
+        return None
+
+    async def process(self, data: ISocketRequest) -> str:
+        return (await self.process_batch([data]))[0]
+
+    async def process_batch(self, data: List[ISocketRequest]) -> List[str]:
+        total = 10
+        for i in range(total):
+            self.send_progress((i + 1) / total)
+            time.sleep(0.1)
+        size = len(data)
+        return [f"[batch size: {size}] {d.extraData['text'][::-1]}" for d in data]
+
+
+register_plugin("batch")(BatchPlugin)
+app = App()